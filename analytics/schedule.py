@@ -0,0 +1,60 @@
+import time
+import numpy as np
+from collect.pages import page_names, get_expired_pages
+from .screen import graham_screen, criteria
+
+# Staleness beyond this many times the time to live does not raise the
+# priority any further.
+max_staleness = 10.0
+
+def get_closeness(companies):
+    """
+    Returns a dict mapping the symbol of each given company to the
+    fraction of Graham's criteria that it passed, from 0 to 1.
+    """
+    companies = list(companies)
+    if not companies:
+        return {}
+    result = graham_screen(companies)
+    passed = np.zeros(len(result))
+    for name in criteria:
+        passed += result[name]
+    return dict(zip(result['symbol'], passed / len(criteria)))
+
+def rank_symbols(symbols, companies, freshness, ttl, new=(), now=None, pages=page_names):
+    """
+    Decides which symbols to refresh first. companies maps the symbol
+    to the stored company (if any), freshness maps it to the fetch time
+    of each page (see CompanyStore.load_freshness()).
+
+    Returns a list of (symbol, score, pages) tuples for all symbols that
+    have expired pages, highest priority first. Symbols that were never
+    fetched, or that are in new (e.g. newly listed), come first. The
+    others are ordered by
+
+        staleness * (1 + 2 * closeness)
+
+    where staleness is the age of the oldest expired page in units of
+    its time to live, and closeness is the fraction of the criteria
+    that the stored data passes. So among equally stale symbols, those
+    closest to passing the screen are refreshed first.
+    """
+    if now is None:
+        now = time.time()
+    new = set(new)
+    closeness = get_closeness(companies.values())
+    ranked = []
+    for symbol in symbols:
+        fetched = freshness.get(symbol, {})
+        if symbol not in companies or not fetched:
+            ranked.append((True, float('inf'), symbol, list(pages)))
+            continue
+        expired = get_expired_pages(fetched, ttl, now, pages)
+        if not expired:
+            continue
+        staleness = max((now - fetched.get(page, 0)) / max(ttl[page], 1) for page in expired)
+        staleness = min(staleness, max_staleness)
+        score = staleness * (1 + 2 * closeness.get(symbol, 0))
+        ranked.append((symbol in new, score, symbol, expired))
+    ranked.sort(key=lambda r: (r[0], r[1]), reverse=True)
+    return [(symbol, score, expired) for is_new, score, symbol, expired in ranked]
@@ -0,0 +1,225 @@
+import numpy as np
+from store.company import Company, field_index
+
+# The names of Graham's seven criteria, in the order of graham_filter().
+criteria = ('rating',
+            'debt-assets',
+            'current-ratio',
+            'net-income',
+            'pe',
+            'p-bv',
+            'dividend')
+
+# The source pages (see collect.pages) that the inputs of each
+# criterion come from.
+criterion_pages = {'rating': ('fmp-rating',),
+                   'debt-assets': ('key-stats', 'balance-sheet'),
+                   'current-ratio': ('key-stats',),
+                   'net-income': ('income-statement',),
+                   'pe': ('key-stats',),
+                   'p-bv': ('key-stats',),
+                   'dividend': ('key-stats',)}
+
+result_dtype = [('symbol', object),
+                ('complete', bool)] + \
+               [(name, bool) for name in criteria] + \
+               [('passed', bool),
+                ('td-ta-ratio', float),
+                ('pe-value', float)]
+
+def _column(companies, key):
+    """
+    Returns the given field of all companies as a float array. Missing
+    and zero values are NaN, like they are "not set" in graham_filter().
+    """
+    return np.array([company.get(key) or np.nan for company in companies],
+                    dtype=float)
+
+def _net_income_matrix(companies):
+    """
+    Returns a (n, years) array containing the net income series of each
+    company in ascending date order, padded with NaN, and an array
+    containing the length of each series.
+    """
+    series = [sorted((company.get('net-income') or {}).items())
+              for company in companies]
+    lengths = np.array([len(s) for s in series], dtype=int)
+    matrix = np.full((len(series), max(lengths.max(initial=0), 1)), np.nan)
+    for i, s in enumerate(series):
+        matrix[i, :len(s)] = [value for date, value in s]
+    return matrix, lengths
+
+# The company fields that the screen reads.
+input_fields = ('rating',
+                'total-debt',
+                'total-assets',
+                'current-ratio',
+                'p-bv',
+                'latest-net-income',
+                'dividend-forward',
+                'pe-forward',
+                'pe-trailing')
+
+def graham_screen(companies):
+    """
+    Evaluates Benjamin Graham's seven criteria for all given companies
+    at once. Returns a numpy structured array with one row per company,
+    containing a boolean column per criterion (see criteria), whether
+    the data was complete, and whether the company passed.
+    Incomplete companies never pass; graham_filter() skips them.
+    """
+    companies = list(companies)
+    if companies and all(isinstance(company, Company) for company in companies):
+        return screen_columns(*_record_columns(companies))
+    columns = dict((key, _column(companies, key)) for key in input_fields)
+    ni, ni_lengths = _net_income_matrix(companies)
+    symbols = [company['symbol'] for company in companies]
+    return screen_columns(symbols, columns, ni, ni_lengths)
+
+def _record_columns(companies):
+    """
+    Like _column() and _net_income_matrix(), but reads the arrays of
+    Company records directly.
+    """
+    values = np.frombuffer(b''.join([c.values.tobytes() for c in companies]))
+    values = values.reshape(len(companies), -1)
+    columns = dict((key, values[:, field_index[key]]) for key in input_fields)
+    lengths = np.array([len(c.ni_values) for c in companies], dtype=int)
+    ni = np.full((len(companies), max(lengths.max(), 1)), np.nan)
+    for i, company in enumerate(companies):
+        ni[i, :lengths[i]] = company.ni_values
+    symbols = [company.symbol for company in companies]
+    return symbols, columns, ni, lengths
+
+def screen_columns(symbols, columns, ni, ni_lengths):
+    """
+    Like graham_screen(), but takes the data as arrays: columns maps
+    each of the input_fields to a float array, ni is a (n, years) array
+    of net income in ascending date order, padded with NaN, and
+    ni_lengths contains the length of each series.
+    """
+    n = len(symbols)
+    columns = dict((key, np.where(columns[key] == 0, np.nan, columns[key]))
+                   for key in input_fields)
+    rating = columns['rating'].copy()
+    rating[np.isnan(rating)] = 3
+    total_debt = columns['total-debt']
+    total_assets = columns['total-assets']
+    current_ratio = columns['current-ratio']
+    p_bv = columns['p-bv']
+    latest_ni = columns['latest-net-income']
+    dividend = columns['dividend-forward']
+    pe_forward = columns['pe-forward']
+    pe = np.where(np.isnan(pe_forward), columns['pe-trailing'], pe_forward)
+    if ni.shape[1] == 0:
+        ni = np.full((n, 1), np.nan)
+
+    result = np.zeros(n, dtype=result_dtype)
+    result['symbol'] = symbols
+    result['complete'] = ~(np.isnan(total_debt)
+                           | np.isnan(total_assets)
+                           | np.isnan(current_ratio)
+                           | np.isnan(p_bv)
+                           | np.isnan(latest_ni)
+                           | np.isnan(pe)
+                           | (ni_lengths == 0))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        td_ta = total_debt / total_assets
+        last_ni = ni[np.arange(n), np.maximum(ni_lengths - 1, 0)]
+        result['rating'] = rating <= 3
+        result['debt-assets'] = td_ta <= 1.10
+        result['current-ratio'] = current_ratio <= 1.50
+        result['net-income'] = ~np.any(ni < 0, axis=1) & (last_ni > ni[:, 0])
+        result['pe'] = pe <= 9
+        result['p-bv'] = p_bv < 1.2
+        result['dividend'] = ~np.isnan(dividend)
+    result['td-ta-ratio'] = td_ta
+    result['pe-value'] = pe
+
+    passed = result['complete'].copy()
+    for name in criteria:
+        passed &= result[name]
+    result['passed'] = passed
+    return result
+
+def early_rejections(company, pages):
+    """
+    Returns the criteria that the given company fails, judging only by
+    the criteria whose pages are all among the given (fetched) pages.
+    A missing value fails its criterion, because a company with
+    incomplete data never passes.
+    """
+    row = graham_screen([company])[0]
+    pages = set(pages)
+    return [name for name in criteria
+            if pages.issuperset(criterion_pages[name]) and not row[name]]
+
+def render_screen(result, dump_successful=True, dump_failed=True):
+    """
+    Prints one line per company of a graham_screen() result, listing
+    the failed criteria.
+    """
+    for row in result:
+        if not row['complete']:
+            if dump_failed:
+                print('{}: incomplete data, skipped'.format(row['symbol']))
+        elif row['passed']:
+            if dump_successful:
+                print('{}: passed'.format(row['symbol']))
+        elif dump_failed:
+            failed = [name for name in criteria if not row[name]]
+            print('{}: failed ({})'.format(row['symbol'], ', '.join(failed)))
+
+def _row_to_dict(row):
+    return dict((name, row[name].item()) for name, dtype in result_dtype[1:])
+
+def _rows_to_result(symbols, rows):
+    result = np.zeros(len(symbols), dtype=result_dtype)
+    result['symbol'] = symbols
+    for name, dtype in result_dtype[1:]:
+        result[name] = [row[name] for row in rows]
+    return result
+
+def incremental_screen(store, symbols=None):
+    """
+    Like graham_screen(), but for the companies in the given
+    CompanyStore, and only evaluates the companies whose data changed
+    since the previous call. The results are saved in the store.
+    If symbols is None, all stored companies are screened.
+    Returns the result and a dict that maps each symbol that was
+    screened before to whether it passed then.
+    """
+    previous = store.load_screen_results(symbols)
+    changed = store.load_changed(symbols)
+    fresh = graham_screen([company for company, fp in changed.values()])
+    rows = dict(previous)
+    saved = []
+    for row in fresh:
+        symbol = row['symbol']
+        rows[symbol] = _row_to_dict(row)
+        saved.append((symbol, changed[symbol][1], rows[symbol]))
+    store.save_screen_results(saved)
+
+    if symbols is None:
+        symbols = sorted(rows)
+    symbols = [symbol for symbol in symbols if symbol in rows]
+    result = _rows_to_result(symbols, [rows[symbol] for symbol in symbols])
+    return result, dict((symbol, row['passed']) for symbol, row in previous.items())
+
+def screen_changes(result, previous):
+    """
+    Compares a screen result to the previous one, as returned by
+    incremental_screen(). Returns three lists of symbols: newly
+    passing, newly failing, and unchanged.
+    """
+    passing, failing, unchanged = [], [], []
+    for row in result:
+        symbol = row['symbol']
+        if row['passed'] and not previous.get(symbol):
+            passing.append(symbol)
+        elif not row['passed'] and previous.get(symbol):
+            failing.append(symbol)
+        else:
+            unchanged.append(symbol)
+    return passing, failing, unchanged
@@ -0,0 +1,281 @@
+"""
+Offline benchmarks for the collectors, the store and the Graham screen.
+Run from the top level directory of the repository:
+
+    python -m bench.run
+    python -m bench.run --sections parse screen --json before.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+from collect import yahoo, fmp
+from collect.util import get_html_from_url, resolve_value
+from collect.fetch import fetch_symbol_data, map_ordered, ParsePool
+from analytics.graham import graham_filter
+from analytics.screen import graham_screen
+from store.company import Company, CompanyStore
+from .server import FixtureServer, load_fixture, fixture_dir, point_collectors_at
+
+def timed(func, repeat=1):
+    """
+    Calls func() repeat times and returns the total time in seconds.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return time.perf_counter() - start
+
+def synthetic_company(n, rnd):
+    def maybe(value):
+        return None if rnd.random() < 0.05 else value
+    years = ['{}-12-31'.format(2018-i) for i in range(4)]
+    return {'symbol': 'S{:06d}'.format(n),
+            'rating': maybe(rnd.randint(1, 5)),
+            'share-price': rnd.uniform(1, 500),
+            'total-debt': maybe(rnd.uniform(0, 1e11)),
+            'total-debt-equity': rnd.uniform(0, 200),
+            'pe-trailing': maybe(rnd.uniform(1, 40)),
+            'pe-forward': maybe(rnd.uniform(1, 40)),
+            'p-bv': maybe(rnd.uniform(0.2, 10)),
+            'dividend-forward': maybe(rnd.uniform(0, 5)),
+            'current-ratio': maybe(rnd.uniform(0.2, 3)),
+            'latest-net-income': rnd.uniform(-1e9, 1e10),
+            'net-income': dict((y, rnd.uniform(-1e9, 1e10)) for y in years),
+            'total-revenue': rnd.uniform(1e6, 1e11),
+            'gross-profit': rnd.uniform(1e6, 1e10),
+            'total-assets': maybe(rnd.uniform(1e8, 1e12))}
+
+def synthetic_universe(size, seed=0):
+    rnd = random.Random(seed)
+    return [synthetic_company(n, rnd) for n in range(size)]
+
+def bench_parse(repeat):
+    """
+    Parse throughput per page type, without any network I/O.
+    """
+    key_stats = load_fixture('key-statistics.html').decode('utf-8')
+    income = load_fixture('financials.html').decode('utf-8')
+    balance = load_fixture('balance-sheet.html').decode('utf-8')
+    rating = load_fixture('fmp-rating.html').decode('utf-8')
+    cases = (('yahoo-key-stats-html', lambda: yahoo.key_stats_from_html(key_stats)),
+             ('yahoo-key-stats-json', lambda: yahoo.key_stats_from_summary(yahoo.get_quote_summary(key_stats))),
+             ('yahoo-income-statement-html', lambda: yahoo.income_statement_from_html(income)),
+             ('yahoo-income-statement-json', lambda: yahoo.income_statement_from_summary(yahoo.get_quote_summary(income))),
+             ('yahoo-balance-sheet-html', lambda: yahoo.balance_sheet_from_html(balance)),
+             ('yahoo-balance-sheet-json', lambda: yahoo.balance_sheet_from_summary(yahoo.get_quote_summary(balance))),
+             ('fmp-rating', lambda: fmp.parse_fmp_json(rating)))
+    results = {}
+    for name, func in cases:
+        func()  # warm up
+        elapsed = timed(func, repeat)
+        results[name] = {'pages-per-second': repeat/elapsed,
+                         'ms-per-page': elapsed/repeat*1000}
+
+    values = ['1.2k', '-3.5M', '114.48B', '106.85', '2,345,678', 'N/A'] * 1000
+    elapsed = timed(lambda: [resolve_value(v) for v in values])
+    results['resolve-value'] = {'values-per-second': len(values)/elapsed}
+
+    companies = synthetic_universe(1000)
+    elapsed = timed(lambda: [graham_filter(dict(c), False, False) for c in companies])
+    results['graham-filter'] = {'companies-per-second': len(companies)/elapsed}
+    return results
+
+def bench_pull(n_symbols, jobs_levels, latency, fmp_batch=False, parse_workers=0):
+    """
+    End-to-end pull throughput against the local fixture server.
+    If fmp_batch is True, FMP ratings are fetched in batches. If
+    parse_workers is given, pages are parsed in a ParsePool.
+    """
+    server = FixtureServer(latency)
+    server.start()
+    point_collectors_at(server.url)
+    pool = ParsePool(parse_workers) if parse_workers else None
+    parser = pool.parse if pool else None
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = CompanyStore(os.path.join(tmp_dir, 'bench.db'))
+            for jobs in jobs_levels:
+                symbols = ['S{:04d}'.format(n) for n in range(n_symbols)]
+                batch = fmp.FmpBatch(symbols) if fmp_batch else None
+                def pull(symbol):
+                    company = fetch_symbol_data(symbol, jobs > 1, fmp_batch=batch, parser=parser)
+                    store.save(company)
+                elapsed = timed(lambda: list(map_ordered(pull, symbols, jobs)))
+                results['jobs-{}'.format(jobs)] = {'symbols-per-second': n_symbols/elapsed}
+            store.close()
+    finally:
+        server.stop()
+        if pool is not None:
+            pool.close()
+    return results
+
+def bench_parse_workers(n_pages, workers_levels):
+    """
+    HTML parse throughput of threads compared to a ParsePool with the
+    same number of workers.
+    """
+    body = load_fixture('key-statistics.html')
+    parse = lambda n: yahoo.parse_page('key-stats', body, 'utf-8', 'html')
+    results = {}
+    for workers in workers_levels:
+        elapsed = timed(lambda: list(map_ordered(parse, range(n_pages), workers)))
+        results['threads-{}'.format(workers)] = {'pages-per-second': n_pages/elapsed}
+        pool = ParsePool(workers)
+        pool_parse = lambda n: pool.parse('key-stats', body, 'utf-8', 'html')
+        pool_parse(0)  # warm up
+        elapsed = timed(lambda: list(map_ordered(pool_parse, range(n_pages), workers)))
+        pool.close()
+        results['processes-{}'.format(workers)] = {'pages-per-second': n_pages/elapsed}
+    return results
+
+def bench_store(size):
+    """
+    Time to write and bulk-load a synthetic universe.
+    """
+    companies = synthetic_universe(size)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = CompanyStore(os.path.join(tmp_dir, 'bench.db'))
+        save = timed(lambda: store.save_many(companies))
+        load = timed(store.load_all)
+        load_records = timed(store.load_companies)
+        store.close()
+    return {'companies': size,
+            'save-seconds': save,
+            'load-seconds': load,
+            'load-records-seconds': load_records,
+            'dict-bytes': _allocated(lambda: synthetic_universe(1000)) / 1000,
+            'record-bytes': _allocated(lambda: [Company.from_dict(c) for c in companies[:1000]]) / 1000}
+
+def _allocated(func):
+    """
+    Returns the number of bytes that remain allocated by the result
+    of func().
+    """
+    import tracemalloc
+    tracemalloc.start()
+    result = func()
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return allocated
+
+def bench_screen(sizes):
+    """
+    Screen time for synthetic universes of the given sizes.
+    """
+    results = {}
+    for size in sizes:
+        companies = synthetic_universe(size)
+        records = [Company.from_dict(c) for c in companies]
+        batch = timed(lambda: graham_screen(companies))
+        batch_records = timed(lambda: graham_screen(records))
+        single = timed(lambda: [graham_filter(dict(c), False, False) for c in companies])
+        results[str(size)] = {'batch-seconds': batch,
+                              'batch-records-seconds': batch_records,
+                              'graham-filter-seconds': single}
+    return results
+
+def bench_startup(repeat):
+    """
+    Wall time of short command line invocations, compared to starting
+    a bare interpreter.
+    """
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'stocklist.py')
+    commands = (('python', [sys.executable, '-c', 'pass']),
+                ('--help', [sys.executable, script, '--help']),
+                ('dir --help', [sys.executable, script, 'dir', '--help']),
+                ('pull --help', [sys.executable, script, 'pull', '--help']))
+    results = {}
+    for name, command in commands:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+        results[name] = {'min-ms': min(times)*1000,
+                         'mean-ms': sum(times)/len(times)*1000}
+    return results
+
+def record_fixtures(symbol='AAPL'):
+    """
+    Replaces the fixtures by the live pages for the given symbol.
+    """
+    pages = (('key-statistics.html', yahoo.yahoo_key_stats_url),
+             ('financials.html', yahoo.yahoo_income_statement_url),
+             ('balance-sheet.html', yahoo.yahoo_balance_sheet_url),
+             ('fmp-rating.html', fmp.rating_url))
+    for name, url in pages:
+        html = get_html_from_url(url % symbol)
+        with open(os.path.join(fixture_dir, name), 'w') as fp:
+            fp.write(html.replace(symbol, 'AAPL'))
+        print('Recorded ' + name)
+
+def main(argv):
+    parser = ArgumentParser(description='Offline benchmarks')
+    parser.add_argument('--sections', nargs='+',
+                        default=['parse', 'pull', 'store', 'screen', 'startup'],
+                        choices=['parse', 'parse-workers', 'pull', 'store', 'screen', 'startup'])
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='iterations per page type in the parse benchmark')
+    parser.add_argument('--symbols', type=int, default=50,
+                        help='number of symbols in the pull benchmark')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 4, 16],
+                        help='concurrency levels in the pull benchmark')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='latency of the fixture server in seconds')
+    parser.add_argument('--fmp-batch', action='store_true',
+                        help='fetch FMP ratings in batches in the pull benchmark')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16],
+                        help='worker counts in the parse-workers benchmark')
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='parse in this many worker processes in the pull benchmark')
+    parser.add_argument('--store-size', type=int, default=10000,
+                        help='number of companies in the store benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='universe sizes in the screen benchmark')
+    parser.add_argument('--json', type=str, default=None,
+                        help='also write the report to this file')
+    parser.add_argument('--record', type=str, default=None, metavar='SYMBOL',
+                        help='record new fixtures from the live sites and exit')
+    args = parser.parse_args(argv)
+
+    if args.record:
+        record_fixtures(args.record)
+        return
+
+    report = {}
+    if 'parse' in args.sections:
+        report['parse'] = bench_parse(args.repeat)
+    if 'parse-workers' in args.sections:
+        report['parse-workers'] = bench_parse_workers(args.repeat * 5, args.workers)
+    if 'pull' in args.sections:
+        report['pull'] = bench_pull(args.symbols, args.jobs, args.latency, args.fmp_batch,
+                                    args.parse_workers)
+    if 'store' in args.sections:
+        report['store'] = bench_store(args.store_size)
+    if 'screen' in args.sections:
+        report['screen'] = bench_screen(args.sizes)
+    if 'startup' in args.sections:
+        report['startup'] = bench_startup(10)
+
+    for section, results in report.items():
+        print(section + ':')
+        for name, values in results.items():
+            if not isinstance(values, dict):
+                print('  {}: {}'.format(name, values))
+                continue
+            values = ', '.join('{}={:.4g}'.format(k, v) for k, v in values.items())
+            print('  {}: {}'.format(name, values))
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
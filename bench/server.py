@@ -0,0 +1,96 @@
+import os
+import re
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collect import yahoo, fmp
+from collect.fmp import parse_fmp_json
+
+fixture_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+fixture_symbol = b'AAPL'
+
+# Maps URL paths to the fixture that is served for them.
+routes = ((re.compile(r'/quote/([^/]+)/key-statistics/'), 'key-statistics.html'),
+          (re.compile(r'/quote/([^/]+)/financials/'), 'financials.html'),
+          (re.compile(r'/quote/([^/]+)/balance-sheet/'), 'balance-sheet.html'),
+          (re.compile(r'/api/company/rating/([^/?]+)'), 'fmp-rating.html'))
+
+def load_fixture(name):
+    with open(os.path.join(fixture_dir, name), 'rb') as fp:
+        return fp.read()
+
+def fmp_batch_response(fixture, symbols):
+    """
+    Builds an FMP response for several comma-separated symbols from
+    the single-symbol fixture.
+    """
+    entry = parse_fmp_json(fixture)[fixture_symbol.decode('ascii')]
+    data = {}
+    for symbol in symbols:
+        symbol = symbol.decode('ascii')
+        data[symbol] = dict(entry, symbol=symbol)
+    return json.dumps(data).encode('utf-8')
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        for regex, name in routes:
+            match = regex.match(self.path)
+            if match:
+                break
+        else:
+            self.send_error(404)
+            return
+        symbols = match.group(1).encode('ascii').split(b',')
+        fixture = self.server.fixtures[name]
+        if name == 'fmp-rating.html':
+            body = fmp_batch_response(fixture, symbols)
+        else:
+            body = fixture.replace(fixture_symbol, symbols[0])
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FixtureServer(ThreadingHTTPServer):
+    """
+    A local HTTP server that replays the recorded fixtures for any
+    symbol, with a configurable latency per request (in seconds).
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, port=0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), FixtureHandler)
+        self.latency = latency
+        self.fixtures = dict((name, load_fixture(name)) for regex, name in routes)
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def point_collectors_at(base_url):
+    """
+    Rewrites the URLs of the Yahoo and FMP collectors to use the
+    given server instead of the live sites.
+    """
+    for module, host in ((yahoo, 'https://finance.yahoo.com'),
+                         (fmp, 'https://financialmodelingprep.com')):
+        for name, value in list(vars(module).items()):
+            if name.endswith('_url') and isinstance(value, str):
+                setattr(module, name, value.replace(host, base_url))
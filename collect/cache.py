@@ -0,0 +1,84 @@
+import time
+import zlib
+import sqlite3
+import threading
+
+schema = '''
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    encoding TEXT,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+'''
+
+class ResponseCache(object):
+    """
+    Stores compressed HTTP response bodies keyed by URL in a single
+    SQLite file, together with the validators (ETag, Last-Modified)
+    that are needed for conditional GET requests.
+    If the total size of the compressed bodies exceeds max_size bytes,
+    the least recently used entries are removed.
+    """
+    def __init__(self, filename, max_size=1024*1024*1024):
+        self.filename = filename
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(schema)
+        row = self.db.execute('SELECT SUM(size) FROM responses').fetchone()
+        self.size = row[0] or 0
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get(self, url):
+        """
+        Returns a dict with the keys body, encoding, etag and
+        last-modified, or None if the URL is not in the cache.
+        """
+        with self.lock, self.db:
+            row = self.db.execute(
+                'SELECT body, encoding, etag, last_modified FROM responses WHERE url=?',
+                (url,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE responses SET accessed=? WHERE url=?',
+                            (time.time(), url))
+        return {'body': zlib.decompress(row[0]),
+                'encoding': row[1],
+                'etag': row[2],
+                'last-modified': row[3]}
+
+    def put(self, url, body, encoding=None, etag=None, last_modified=None):
+        data = zlib.compress(body)
+        with self.lock, self.db:
+            row = self.db.execute('SELECT size FROM responses WHERE url=?',
+                                  (url,)).fetchone()
+            if row is not None:
+                self.size -= row[0]
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (url, etag, last_modified, encoding, data, len(data), time.time()))
+            self.size += len(data)
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # Remove the least recently used entries until we are 10% below
+        # the limit, so that we do not evict on every put().
+        target = self.max_size * 0.9
+        rows = self.db.execute('SELECT url, size FROM responses ORDER BY accessed')
+        remove = []
+        for url, size in rows:
+            if self.size <= target:
+                break
+            remove.append((url,))
+            self.size -= size
+        self.db.executemany('DELETE FROM responses WHERE url=?', remove)
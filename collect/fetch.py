@@ -0,0 +1,222 @@
+import sys
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .fmp import FmpCompany
+from .yahoo import YahooCompany, timed_parse_page
+from .pages import page_names
+from .stats import stats
+
+def _prefetch(*getters):
+    """
+    Calls the given functions concurrently, one thread each. Used to
+    download the independent pages of a single symbol in parallel.
+    Once all calls returned, the first error (in the order of the
+    getters) is raised, so a failed page is not requested again.
+    """
+    with ThreadPoolExecutor(max_workers=len(getters)) as executor:
+        futures = [executor.submit(getter) for getter in getters]
+    for future in futures:
+        future.result()
+
+class ParsePool(object):
+    """
+    Parses Yahoo pages in a pool of worker processes, so that parsing
+    is not serialized by the GIL of the threads that download them.
+    Pass its parse() method as the parser of a YahooCompany; the
+    calling thread waits for the result without holding the GIL.
+    FMP responses are small JSON documents and are decoded in the
+    calling thread.
+    """
+    def __init__(self, processes=None):
+        self.executor = ProcessPoolExecutor(max_workers=processes)
+        # The workers are forked on the first submit; do it now, so that
+        # they are not forked from a download thread.
+        self.executor.submit(int).result()
+
+    def parse(self, page, body, encoding=None, mode='auto'):
+        future = self.executor.submit(timed_parse_page, page, body, encoding, mode)
+        result, seconds = future.result()
+        stats.add_time('parse', 'yahoo-' + page, seconds)
+        return result
+
+    def close(self):
+        self.executor.shutdown()
+
+def get_page_fields(page, fmp_company, yahoo_company):
+    """
+    Returns a dict containing the fields of a company that are taken
+    from the given source page.
+    """
+    if page == 'fmp-rating':
+        return {'rating': fmp_company.rating}
+    elif page == 'key-stats':
+        return {'share-price': yahoo_company.share_price,
+                'total-debt': yahoo_company.total_debt,
+                'total-debt-equity': yahoo_company.total_debt_equity,
+                'pe-trailing': yahoo_company.pe_trailing,
+                'pe-forward': yahoo_company.pe_forward,
+                'p-bv': yahoo_company.p_bv,
+                'dividend-forward': yahoo_company.dividend_forward,
+                'current-ratio': yahoo_company.current_ratio}
+    elif page == 'income-statement':
+        return {'latest-net-income': yahoo_company.net_income,
+                'net-income': yahoo_company.get_net_income_series(),
+                'total-revenue': yahoo_company.revenue,
+                'gross-profit': yahoo_company.gross_profit}
+    elif page == 'balance-sheet':
+        return {'total-assets': yahoo_company.total_assets}
+    elif page == 'stockrow':
+        # The history is optional; if it fails, leave it out, so that
+        # the page is not marked as fetched (see fetched_pages()).
+        from .stockrow import read_balance_sheet_history
+        try:
+            history = read_balance_sheet_history(yahoo_company.symbol)
+        except Exception:
+            stats.count('stockrow', 'failed')
+            return {}
+        return {'balance-sheet-history': history}
+    raise ValueError('unknown page: ' + repr(page))
+
+def fetched_pages(pages, company):
+    """
+    Returns the given pages, except for optional pages that
+    get_page_fields() could not retrieve for the given company.
+    """
+    return [page for page in pages
+            if page != 'stockrow' or 'balance-sheet-history' in company]
+
+def fetch_symbol_data(symbol, parallel=False, pages=None, fmp_batch=None, parser=None):
+    """
+    Retrieve the data for the given symbol from Yahoo and FMP.
+    If parallel is True, the pages are downloaded concurrently.
+    If pages is given, only the fields from these source pages
+    are retrieved (see page_names and optional_page_names).
+    If fmp_batch is given, the FMP data is taken from that FmpBatch.
+    parser is passed to YahooCompany, e.g. the parse() method of a
+    ParsePool.
+    """
+    if pages is None:
+        pages = list(page_names)
+    if fmp_batch is not None:
+        fmp_company = fmp_batch.company(symbol)
+    else:
+        fmp_company = FmpCompany(symbol)
+    yahoo_company = YahooCompany(symbol, parser=parser)
+    if parallel and len(pages) > 1:
+        getters = {'fmp-rating': lambda: fmp_company.rating,
+                   'key-stats': lambda: yahoo_company.yahoo_key_stats,
+                   'income-statement': lambda: yahoo_company.yahoo_income_statement,
+                   'balance-sheet': lambda: yahoo_company.yahoo_balance_sheet}
+        _prefetch(*[getters[page] for page in pages if page in getters])
+    company = {'symbol': symbol}
+    for page in pages:
+        company.update(get_page_fields(page, fmp_company, yahoo_company))
+    return company
+
+def map_ordered(func, items, jobs=1):
+    """
+    Calls func(item) for every item, using up to `jobs` threads.
+    Yields (item, result, error) tuples in the order of the input,
+    where error is the exception raised by func (or None). A failing
+    item never stops the run.
+
+    At most 2 * jobs items are in flight at any time, so memory use
+    does not depend on the number of items.
+    """
+    if jobs <= 1:
+        for item in items:
+            try:
+                yield item, func(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    pending = deque()
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) < jobs * 2:
+                continue
+            item, future = pending.popleft()
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+        while pending:
+            item, future = pending.popleft()
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+
+def map_unordered(func, items, jobs=1, queue_size=None):
+    """
+    Like map_ordered(), but yields the results as soon as they are
+    available. The input is read by a separate producer thread, so a
+    slow source (like a download) and the workers run concurrently.
+    Producer, workers and consumer are connected by bounded queues of
+    the given size (default: 2 * jobs), so memory use stays flat
+    regardless of the number of items.
+    If reading the input fails, the error is raised after all items
+    that were read have been processed.
+    """
+    if queue_size is None:
+        queue_size = jobs * 2
+    done = object()
+    stop = threading.Event()
+    input_queue = queue.Queue(queue_size)
+    output_queue = queue.Queue(queue_size)
+    producer_errors = []
+
+    def produce():
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+                input_queue.put(item)
+        except Exception as e:
+            producer_errors.append(e)
+        finally:
+            for _ in range(jobs):
+                input_queue.put(done)
+
+    def work():
+        while not stop.is_set():
+            item = input_queue.get()
+            if item is done:
+                break
+            try:
+                output_queue.put((item, func(item), None))
+            except Exception as e:
+                output_queue.put((item, None, e))
+        output_queue.put(done)
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads += [threading.Thread(target=work, daemon=True) for _ in range(jobs)]
+    for thread in threads:
+        thread.start()
+    try:
+        running = jobs
+        while running:
+            result = output_queue.get()
+            if result is done:
+                running -= 1
+                continue
+            yield result
+    finally:
+        stop.set()
+    if producer_errors:
+        raise producer_errors[0]
+
+def progress(n, total, symbol, error=None):
+    """
+    Writes a one-line progress report for the given symbol to stderr.
+    total may be None if the number of symbols is not known.
+    """
+    status = 'ok' if error is None else 'failed: {}'.format(error)
+    count = n if total is None else '{}/{}'.format(n, total)
+    sys.stderr.write('[{}] {} {}\n'.format(count, symbol, status))
+    sys.stderr.flush()
@@ -1,5 +1,9 @@
 import json
-from .util import get_soup_from_url
+import html
+import threading
+from .util import get_content_from_url
+from .limiter import SourceUnavailable
+from .stats import stats
 
 stock_list_url = 'https://financialmodelingprep.com/api/stock/losers'
 profile_url = 'https://financialmodelingprep.com/public/api/company/profile/%s'
@@ -8,13 +12,38 @@ rating_url = 'https://financialmodelingprep.com/api/company/rating/%s'
 balance_sheet_url = 'https://financialmodelingprep.com/api/financials/balance-sheet-statement/%s'
 cash_flow_url = 'https://financialmodelingprep.com/api/financials/cash-flow-statement/%s'
 
+def parse_fmp_json(data_json):
+    """
+    Decodes the JSON from a financialmodelingprep.com response (bytes
+    or string). Some endpoints wrap the JSON in a <pre> tag; it is
+    stripped without parsing the HTML.
+    """
+    with stats.timer('parse', 'fmp'):
+        if isinstance(data_json, str):
+            data_json = data_json.encode('utf-8')
+        start = data_json.find(b'<pre>')
+        if start >= 0:
+            end = data_json.rfind(b'</pre>')
+            data_json = data_json[start+5:end if end > start else None]
+            data_json = html.unescape(data_json.decode('utf-8'))
+        return json.loads(data_json)
+
 def get_from_fmp_url(url):
     """
     Returns the JSON from the given financialmodelingprep.com URL.
     """
-    soup = get_soup_from_url(url)
-    data_json = soup.pre.get_text()
-    return json.loads(data_json)
+    body, encoding = get_content_from_url(url)
+    return parse_fmp_json(body)
+
+def parse_rating(data):
+    """
+    Returns the rating from the given entry of a rating response as an
+    integer, or None.
+    """
+    try:
+        return int(data['rating'])
+    except (KeyError, TypeError, ValueError):
+        return None
 
 def get_stock_list_from_url(url):
     """
@@ -24,11 +53,70 @@ def get_stock_list_from_url(url):
     """
     return get_from_fmp_url(url)
 
+class FmpBatch(object):
+    """
+    Fetches the rating and profile of many symbols, using one request
+    per batch_size symbols (the tickers are comma-separated in the URL).
+    A batch is fetched when the first of its symbols is accessed.
+    If a batch request fails, its companies fetch their data one by one.
+    """
+    def __init__(self, symbols, batch_size=100):
+        self.symbols = list(symbols)
+        self.batch_size = batch_size
+        self.batch_index = dict((s, n // batch_size) for n, s in enumerate(self.symbols))
+        self.lock = threading.Lock()
+        self.batch_locks = {}
+        self.results = {}
+
+    def _get_batch(self, url, symbol):
+        batch = self.batch_index.get(symbol)
+        if batch is None:
+            return None
+        key = url, batch
+        with self.lock:
+            lock = self.batch_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self.results:
+                start = batch * self.batch_size
+                symbols = self.symbols[start:start+self.batch_size]
+                try:
+                    data = get_from_fmp_url(url % ','.join(symbols))
+                except (IOError, ValueError):
+                    data = None
+                self.results[key] = data if isinstance(data, dict) else None
+            return self.results[key]
+
+    def get_rating(self, symbol):
+        """
+        Returns the rating entry for the given symbol, or None if the
+        batch failed or does not include the symbol, in which case the
+        FmpCompany requests it on its own.
+        """
+        data = self._get_batch(rating_url, symbol)
+        if data is None or symbol not in data:
+            return None
+        return data[symbol] or {}
+
+    def get_profile(self, symbol):
+        data = self._get_batch(profile_url, symbol)
+        if data is None or symbol not in data:
+            return None
+        return data[symbol] or {}
+
+    def company(self, symbol):
+        """
+        Returns an FmpCompany that takes its rating and profile from
+        this batch.
+        """
+        return FmpCompany(symbol, batch=self)
+
 class FmpCompany(object):
-    def __init__(self, symbol):
+    def __init__(self, symbol, batch=None):
         self.symbol = symbol
+        self.batch = batch
         self._profile = None
         self._rating = None
+        self._rating_missing = False
         self._income_statement = None
         self._balance_sheet = None
         self._cash_flow = None
@@ -37,8 +125,12 @@ class FmpCompany(object):
     def profile(self):
         if self._profile is not None:
             return self._profile
-        data = get_from_fmp_url(profile_url % symbol)
-        self._profile = data[symbol]
+        if self.batch is not None:
+            self._profile = self.batch.get_profile(self.symbol)
+            if self._profile is not None:
+                return self._profile
+        data = get_from_fmp_url(profile_url % self.symbol)
+        self._profile = data[self.symbol]
         return self._profile
 
     @property
@@ -51,17 +143,23 @@ class FmpCompany(object):
         2 = buy
         1 = strong buy
         0 = unrated?
+
+        Returns None if FMP has no rating for the symbol or fails to
+        respond; the Graham filter then assumes an average rating.
         """
-        if self._rating is not None:
+        if self._rating is not None or self._rating_missing:
             return self._rating
-        try:
-            data = get_from_fmp_url(rating_url % self.symbol)
-        except AttributeError:
-            return None
-        try:
-            self._rating = int(data[self.symbol]['rating'])
-        except ValueError:
-            return None
+        data = self.batch.get_rating(self.symbol) if self.batch else None
+        if data is None:
+            try:
+                data = get_from_fmp_url(rating_url % self.symbol)[self.symbol]
+            except SourceUnavailable:
+                # Let the caller defer the symbol until FMP recovers.
+                raise
+            except (IOError, KeyError, TypeError, ValueError):
+                self._rating_missing = True
+                return None
+        self._rating = parse_rating(data)
         return self._rating
 
     @property
@@ -0,0 +1,194 @@
+import time
+import threading
+
+limiter_config = {'initial': 4,
+                  'minimum': 1,
+                  'maximum': 32,
+                  'failure_threshold': 5,
+                  'cooldown': 30,
+                  'max_cooldown': 600}
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+class SourceUnavailable(IOError):
+    """
+    Raised when a request is refused because the circuit breaker of
+    its host is open, or because the host keeps rate limiting us.
+    """
+    pass
+
+class HostLimiter(object):
+    """
+    Limits the number of concurrent requests to a single host, and
+    adapts the limit to how the host responds (AIMD): the limit grows
+    by one per round of successful requests, and is halved when the
+    host answers with 429 or 5xx, fails, or gets slower than twice its
+    usual latency.
+
+    After failure_threshold consecutive failures, the circuit breaker
+    opens: requests raise SourceUnavailable for cooldown seconds, after
+    which a single request is let through. If it succeeds the breaker
+    closes, otherwise it opens again for twice as long.
+    """
+    # Minimum time between two decreases of the limit, so that a burst
+    # of errors from requests that were already in flight counts once.
+    window = 1.0
+
+    # Time to wait after a 429 response without a Retry-After header.
+    pause = 5.0
+
+    # Number of responses to observe before latency lowers the limit.
+    min_samples = 10
+
+    def __init__(self, host, initial=4, minimum=1, maximum=32,
+                 failure_threshold=5, cooldown=30, max_cooldown=600):
+        self.host = host
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.failure_threshold = failure_threshold
+        self.initial_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.latency = None
+        self.base_latency = None
+        self.samples = 0
+        self.last_decrease = 0
+        self.failures = 0
+        self.open_until = 0
+        self.paused_until = 0
+        self.probing = False
+
+    def acquire(self):
+        """
+        Blocks until a request to the host may be sent. Raises
+        SourceUnavailable if the circuit breaker is open.
+        """
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.open_until > now:
+                    raise SourceUnavailable('{} is unavailable for {:.0f}s'.format(
+                        self.host, self.open_until - now))
+                if self.failures >= self.failure_threshold:
+                    # Half open: let a single request probe the host.
+                    if self.probing:
+                        raise SourceUnavailable('{} is being probed'.format(self.host))
+                    self.probing = True
+                    self.in_flight += 1
+                    return
+                if self.paused_until > now:
+                    self.condition.wait(self.paused_until - now)
+                    continue
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                self.condition.wait()
+
+    def _decrease(self, now):
+        if now - self.last_decrease < self.window:
+            return
+        self.last_decrease = now
+        self.limit = max(self.minimum, self.limit / 2)
+
+    def _observe(self, latency, now):
+        if self.latency is None:
+            self.latency = self.base_latency = latency
+        self.samples += 1
+        self.latency = 0.8 * self.latency + 0.2 * latency
+        # The baseline follows lasting changes of the latency slowly.
+        self.base_latency = min(self.latency, self.base_latency * 1.01)
+        if self.samples >= self.min_samples and self.latency > 2 * self.base_latency:
+            self._decrease(now)
+        else:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def release(self, outcome, latency=None, retry_after=None):
+        """
+        Reports the outcome of a request that was started after
+        acquire(): "ok" (with its latency in seconds), "throttled"
+        for a 429 response (with the Retry-After delay, if given), or
+        "error" for a 5xx response or a failed connection.
+        """
+        with self.condition:
+            now = time.time()
+            self.in_flight -= 1
+            self.probing = False
+            if outcome == 'ok':
+                self.failures = 0
+                self.cooldown = self.initial_cooldown
+                if latency is not None:
+                    self._observe(latency, now)
+            elif outcome == 'throttled':
+                self._decrease(now)
+                self.paused_until = max(self.paused_until, now + (retry_after or self.pause))
+            else:
+                self.failures += 1
+                self._decrease(now)
+                if self.failures >= self.failure_threshold and self.open_until <= now:
+                    self.open_until = now + self.cooldown
+                    self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self.condition.notify_all()
+
+    def unavailable_for(self):
+        """
+        Returns the number of seconds until the circuit breaker lets
+        requests through again, or 0.
+        """
+        with self.condition:
+            return max(0, self.open_until - time.time(), self.paused_until - time.time())
+
+    def state(self):
+        with self.condition:
+            if self.open_until > time.time():
+                breaker = 'open'
+            elif self.failures >= self.failure_threshold:
+                breaker = 'half-open'
+            else:
+                breaker = 'closed'
+            return {'limit': int(self.limit),
+                    'latency': self.latency,
+                    'breaker': breaker}
+
+def configure_limits(**kwargs):
+    """
+    Changes the settings (see limiter_config) of all host limiters,
+    e.g. configure_limits(maximum=16). Limiters that already exist
+    are replaced.
+    """
+    for key, value in kwargs.items():
+        if key not in limiter_config:
+            raise TypeError('unknown limiter setting: ' + repr(key))
+        if value is not None:
+            limiter_config[key] = value
+    with _limiters_lock:
+        _limiters.clear()
+
+def get_limiter(host):
+    """
+    Returns the HostLimiter of the given host.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = _limiters[host] = HostLimiter(host, **limiter_config)
+        return limiter
+
+def get_limiter_states():
+    """
+    Returns a dict mapping each host to the state of its limiter.
+    """
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return dict((limiter.host, limiter.state()) for limiter in limiters)
+
+def unavailable_for():
+    """
+    Returns the number of seconds until all hosts accept requests
+    again, or 0.
+    """
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return max([limiter.unavailable_for() for limiter in limiters] + [0])
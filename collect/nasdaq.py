@@ -1,20 +1,136 @@
+import os
 import re
-from ftplib import FTP
-from io import StringIO
-
-def get_nasdaq_stocks(filename, column):
-    ftp = FTP('ftp.nasdaqtrader.com')
-    ftp.login()
-    ftp.cwd('SymbolDirectory')
-    lines = StringIO()
-    ftp.retrlines('RETR '+filename, lambda x: lines.write(str(x)+'\n'))
-    ftp.quit()
-    lines.seek(0)
-    result = [l.split('|')[column] for l in lines.readlines()]
-    return [l for l in result if re.match(r'^[A-Z]+$', l)]
-
-def get_nasdaq_traded_stocks():
-    return get_nasdaq_stocks('nasdaqtraded.txt', 1)
-
-def get_nasdaq_listed_stocks():
-    return get_nasdaq_stocks('nasdaqlisted.txt', 0)
+import time
+
+ftp_host = 'ftp.nasdaqtrader.com'
+symbol_re = re.compile(r'[A-Z]+$')
+
+# Maps the name of each symbol directory to the file name on the FTP
+# server, and the column that contains the symbol.
+directories = {'nasdaq-traded': ('nasdaqtraded.txt', 1),
+               'nasdaq-listed': ('nasdaqlisted.txt', 0)}
+
+# Maps the header of the directory columns that iter_nasdaq_rows()
+# returns to their keys.
+row_columns = {'Symbol': 'symbol',
+               'Security Name': 'name',
+               'Listing Exchange': 'exchange',
+               'Market Category': 'market-category',
+               'ETF': 'etf',
+               'Test Issue': 'test-issue',
+               'Financial Status': 'financial-status'}
+
+def iter_ftp_lines(filename):
+    """
+    Yields the lines of the given file in the NASDAQ symbol directory
+    while it is downloaded.
+    """
+    from ftplib import FTP
+    ftp = FTP(ftp_host)
+    try:
+        ftp.login()
+        ftp.cwd('SymbolDirectory')
+        ftp.voidcmd('TYPE A')
+        conn = ftp.transfercmd('RETR '+filename)
+        with conn, conn.makefile('r', encoding='latin-1') as fp:
+            for line in fp:
+                yield line.rstrip('\r\n')
+        ftp.voidresp()
+        ftp.quit()
+    finally:
+        ftp.close()
+
+def iter_nasdaq_lines(filename, cache_dir=None, max_age=None):
+    """
+    Like iter_ftp_lines(), but if cache_dir is given, a copy of the file
+    is stored there once it was downloaded completely. The previous
+    copy is kept as <filename>.prev for get_nasdaq_changes().
+    If the copy is younger than max_age seconds, it is read instead of
+    downloading the file again.
+    """
+    if cache_dir is None:
+        for line in iter_ftp_lines(filename):
+            yield line
+        return
+
+    path = os.path.join(cache_dir, filename)
+    if max_age is not None \
+            and os.path.isfile(path) \
+            and time.time() - os.path.getmtime(path) < max_age:
+        with open(path) as fp:
+            for line in fp:
+                yield line.rstrip('\n')
+        return
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        for line in iter_ftp_lines(filename):
+            fp.write(line + '\n')
+            yield line
+    if os.path.isfile(path):
+        os.replace(path, path + '.prev')
+    os.replace(tmp_path, path)
+
+def iter_nasdaq_stocks(filename, column, cache_dir=None, max_age=None):
+    """
+    Yields the stock symbols from the given file in the NASDAQ symbol
+    directory while it is downloaded. See iter_nasdaq_lines() for the
+    cache_dir and max_age arguments.
+    """
+    for line in iter_nasdaq_lines(filename, cache_dir, max_age):
+        fields = line.split('|')
+        if len(fields) > column and symbol_re.match(fields[column]):
+            yield fields[column]
+
+def iter_nasdaq_rows(filename, cache_dir=None, max_age=None):
+    """
+    Like iter_nasdaq_stocks(), but yields a dict per symbol containing
+    the columns of the directory that describe the security, see
+    row_columns. "etf" and "test-issue" are booleans. nasdaqlisted.txt
+    has no exchange column; its exchange is "Q" (NASDAQ).
+    """
+    lines = iter_nasdaq_lines(filename, cache_dir, max_age)
+    header = next(lines, '').split('|')
+    if 'Symbol' not in header:
+        raise ValueError('unexpected header in {}: {!r}'.format(filename, header))
+    symbol_column = header.index('Symbol')
+    columns = [(n, row_columns[name]) for n, name in enumerate(header)
+               if name in row_columns]
+    for line in lines:
+        fields = line.split('|')
+        if len(fields) != len(header) or not symbol_re.match(fields[symbol_column]):
+            continue
+        row = {'exchange': 'Q', 'financial-status': ''}
+        for n, key in columns:
+            row[key] = fields[n].strip()
+        row['etf'] = row.get('etf') == 'Y'
+        row['test-issue'] = row.get('test-issue') == 'Y'
+        yield row
+
+def _read_symbols(path, column):
+    if not os.path.isfile(path):
+        return set()
+    with open(path) as fp:
+        fields = (line.rstrip('\n').split('|') for line in fp)
+        return set(f[column] for f in fields
+                   if len(f) > column and symbol_re.match(f[column]))
+
+def get_nasdaq_changes(filename, column, cache_dir):
+    """
+    Compares the cached copy of the given file with the previous copy
+    and returns a tuple (added, removed) containing two sorted lists of
+    symbols.
+    """
+    path = os.path.join(cache_dir, filename)
+    current = _read_symbols(path, column)
+    previous = _read_symbols(path + '.prev', column)
+    return sorted(current - previous), sorted(previous - current)
+
+def get_nasdaq_stocks(filename, column, cache_dir=None, max_age=None):
+    return list(iter_nasdaq_stocks(filename, column, cache_dir, max_age))
+
+def get_nasdaq_traded_stocks(cache_dir=None, max_age=None):
+    return get_nasdaq_stocks('nasdaqtraded.txt', 1, cache_dir, max_age)
+
+def get_nasdaq_listed_stocks(cache_dir=None, max_age=None):
+    return get_nasdaq_stocks('nasdaqlisted.txt', 0, cache_dir, max_age)
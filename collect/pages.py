@@ -0,0 +1,53 @@
+# Only uses the standard library, so that the command line tool can
+# import it without loading any of the collectors.
+import re
+import time
+
+# The source pages that make up the data of a company, cheapest first.
+page_names = ('key-stats', 'income-statement', 'balance-sheet', 'fmp-rating')
+
+# Pages that are only fetched on request, because they are expensive.
+optional_page_names = ('stockrow',)
+
+# Default time to live of each page, in seconds.
+default_ttl = {'key-stats': 24*60*60,
+               'income-statement': 30*24*60*60,
+               'balance-sheet': 30*24*60*60,
+               'fmp-rating': 7*24*60*60,
+               'stockrow': 30*24*60*60}
+
+def parse_duration(value):
+    """
+    Converts "90", "30s", "15m", "12h", "1d" or "2w" to seconds.
+    """
+    units = dict(s=1, m=60, h=60*60, d=24*60*60, w=7*24*60*60)
+    match = re.match(r'(\d+\.?\d*)([smhdw]?)$', value.strip(), re.I)
+    if not match:
+        raise ValueError('invalid duration: ' + repr(value))
+    number, unit = match.groups()
+    return float(number) * units.get(unit.lower() or 's')
+
+def parse_ttl(values):
+    """
+    Parses a list of "page=duration" strings, e.g. "key-stats=12h",
+    and returns the resulting time to live for every page.
+    """
+    ttl = dict(default_ttl)
+    for value in values:
+        page, _, duration = value.partition('=')
+        if page not in ttl:
+            raise ValueError('unknown page: ' + repr(page))
+        ttl[page] = parse_duration(duration)
+    return ttl
+
+def get_expired_pages(freshness, ttl, now=None, pages=page_names):
+    """
+    Given a dict mapping page names to the time when they were last
+    fetched, returns the list of the given pages that are older than
+    their time to live (in seconds). Pages that were never fetched are
+    always expired.
+    """
+    if now is None:
+        now = time.time()
+    return [page for page in pages
+            if now - freshness.get(page, 0) > ttl[page]]
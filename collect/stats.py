@@ -0,0 +1,103 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets, in milliseconds.
+bucket_bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+class Histogram(object):
+    """
+    A latency histogram with fixed, roughly logarithmic buckets.
+    """
+    def __init__(self):
+        self.buckets = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.buckets[bisect.bisect_left(bucket_bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+
+    def percentile(self, p):
+        """
+        Returns the upper bound of the bucket that contains the given
+        percentile, in milliseconds.
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for bound, n in zip(bucket_bounds + (self.max,), self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        buckets = dict(('<={}ms'.format(b), n)
+                       for b, n in zip(bucket_bounds, self.buckets) if n)
+        if self.buckets[-1]:
+            buckets['>{}ms'.format(bucket_bounds[-1])] = self.buckets[-1]
+        return {'count': self.count,
+                'total-ms': self.total,
+                'mean-ms': self.total / self.count if self.count else None,
+                'min-ms': self.min,
+                'max-ms': self.max,
+                'p50-ms': self.percentile(50),
+                'p90-ms': self.percentile(90),
+                'p99-ms': self.percentile(99),
+                'buckets': buckets}
+
+class Stats(object):
+    """
+    Thread-safe collection of latency histograms and counters, each
+    identified by a category (like "http") and a name (like a host).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def add_time(self, category, name, seconds):
+        with self.lock:
+            histograms = self.histograms.setdefault(category, {})
+            if name not in histograms:
+                histograms[name] = Histogram()
+            histograms[name].add(seconds)
+
+    def count(self, category, name, n=1):
+        with self.lock:
+            counters = self.counters.setdefault(category, {})
+            counters[name] = counters.get(name, 0) + n
+
+    @contextmanager
+    def timer(self, category, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(category, name, time.perf_counter() - start)
+
+    def report(self):
+        """
+        Returns all histograms and counters as a JSON serializable dict.
+        """
+        with self.lock:
+            report = dict((category, dict((name, h.to_dict()) for name, h in hists.items()))
+                          for category, hists in self.histograms.items())
+            for category, counters in self.counters.items():
+                report.setdefault(category, {}).update(counters)
+        return report
+
+stats = Stats()
@@ -1,8 +1,8 @@
-from io import StringIO
 import os
-import requests
-import pandas as pd
-from util import download_from_url
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from .util import download_from_url
 
 income_statement_url = 'https://stockrow.com/api/companies/{}/financials.xlsx?dimension=MRY&section=Income%20Statement&sort=desc'
 balance_sheet_url = 'https://stockrow.com/api/companies/{}/financials.xlsx?dimension=MRY&section=Balance%20Sheet&sort=desc'
@@ -10,29 +10,141 @@ cash_flow_url = 'https://stockrow.com/api/companies/{}/financials.xlsx?dimension
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 data_dir = os.path.join(parent_dir, 'data', 'sr')
-if not os.path.isdir(data_dir):
-    os.makedirs(data_dir)
+
+# Maps the name of each statement to its URL and file name suffix.
+statements = {'income_stmt': (income_statement_url, '.income_stmt.xlsx'),
+              'balance_sheet': (balance_sheet_url, '.balance_sheet.xlsx'),
+              'cash_flow': (cash_flow_url, '.cash_flow.xlsx')}
+
+# Maps company fields to the (lower case) row labels of the balance sheet.
+balance_sheet_labels = {'total-assets': 'total assets',
+                        'total-debt': 'total debt',
+                        'current-assets': 'total current assets',
+                        'current-liabilities': 'total current liabilities'}
+
+def get_filename(symbol, suffix):
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    return os.path.join(data_dir, symbol+suffix)
+
+def download_statement(symbol, name, force=True):
+    url, suffix = statements[name]
+    filename = get_filename(symbol, suffix)
+    return download_from_url(url.format(symbol), filename, overwrite=force)
 
 def download_income_stmt(symbol, force=True):
-    url = income_statement_url.format(symbol)
-    filename = os.path.join(data_dir, symbol+'.income_stmt.xlsx')
-    return download_from_url(url, filename, overwrite=force)
+    return download_statement(symbol, 'income_stmt', force)
 
 def download_balance_sheet(symbol, force=True):
-    url = balance_sheet_url.format(symbol)
-    filename = os.path.join(data_dir, symbol+'.balance_sheet.xlsx')
-    return download_from_url(url, filename, overwrite=force)
+    return download_statement(symbol, 'balance_sheet', force)
 
 def download_cash_flow(symbol, force=True):
-    url = cash_flow_url.format(symbol)
-    filename = os.path.join(data_dir, symbol+'.cash_flow.xlsx')
-    return download_from_url(url, filename, overwrite=force)
+    return download_statement(symbol, 'cash_flow', force)
+
+def _digest(filename):
+    with open(filename, 'rb') as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+def read_statement(filename):
+    """
+    Returns the given xlsx file as a pandas DataFrame. The parsed frame
+    is cached in <filename>.pkl together with a hash of the xlsx file,
+    so the (slow) xlsx parser only runs when the download changed.
+    """
+    digest = _digest(filename)
+    cache_file = filename + '.pkl'
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'rb') as fp:
+            try:
+                cached = pickle.load(fp)
+            except Exception:
+                # Truncated or written by another pandas version.
+                cached = None
+        if cached is not None and cached['digest'] == digest:
+            return cached['frame']
+
+    import pandas as pd
+    frame = pd.read_excel(filename, index_col=0)
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'wb') as fp:
+        pickle.dump({'digest': digest, 'frame': frame}, fp, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    return frame
+
+def _warm_cache(filename):
+    read_statement(filename)
+
+def ingest(symbols, force=True, jobs=1, processes=None, names=None):
+    """
+    Downloads the statements of all given symbols using `jobs` threads,
+    then parses the new downloads across a pool of worker processes, so
+    that Stockrow objects for these symbols can be created from the
+    cache. names is a list of statement names (default: all).
+    Yields (symbol, error) tuples for symbols that failed.
+    """
+    from .fetch import map_ordered
+    if names is None:
+        names = list(statements)
+    def download(symbol):
+        return [download_statement(symbol, name, force) for name in names]
+    filenames = []
+    for symbol, files, error in map_ordered(download, symbols, jobs):
+        if error is not None:
+            yield symbol, error
+            continue
+        filenames += [(symbol, f) for f in files]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for symbol, future in [(s, executor.submit(_warm_cache, f)) for s, f in filenames]:
+            try:
+                future.result()
+            except Exception as e:
+                yield symbol, e
+
+def get_balance_sheet_history(frame):
+    """
+    Returns a dict mapping the date of each annual balance sheet in the
+    given frame to a dict containing the fields in balance_sheet_labels,
+    e.g.::
+
+        {"2018-09-29": {"total-assets": 365725000000.0, ...}}
+    """
+    import pandas as pd
+    rows = dict((str(label).strip().lower(), label) for label in frame.index)
+    history = {}
+    for column in frame.columns:
+        try:
+            date = pd.Timestamp(column).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+        entry = {}
+        for key, label in balance_sheet_labels.items():
+            if label not in rows:
+                continue
+            value = frame.at[rows[label], column]
+            entry[key] = None if pd.isna(value) else float(value)
+        history[date] = entry
+    return history
+
+def read_balance_sheet_history(symbol, force=False):
+    """
+    Like Stockrow(symbol).balance_sheet_history, but only downloads
+    and parses the balance sheet.
+    """
+    return get_balance_sheet_history(read_statement(download_balance_sheet(symbol, force)))
 
 class Stockrow(object):
     def __init__(self, symbol, force=False):
-        self.income_stmt = pd.read_excel(download_income_stmt(symbol, force))
-        self.balance_sheet = pd.read_excel(download_balance_sheet(symbol, force))
-        self.cash_flow = pd.read_excel(download_cash_flow(symbol, force))
+        self.symbol = symbol
+        self.income_stmt = read_statement(download_income_stmt(symbol, force))
+        self.balance_sheet = read_statement(download_balance_sheet(symbol, force))
+        self.cash_flow = read_statement(download_cash_flow(symbol, force))
+
+    @property
+    def balance_sheet_history(self):
+        """
+        See get_balance_sheet_history().
+        """
+        return get_balance_sheet_history(self.balance_sheet)
 
     def dump(self):
         print(self.income_stmt.head())
@@ -1,29 +1,223 @@
 import os
 import re
+import time
+import threading
+from urllib.parse import urlparse
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
+from .cache import ResponseCache
+from .limiter import get_limiter, SourceUnavailable
+from .stats import stats
+
+try:
+    import lxml
+    html_parser = 'lxml'
+except ImportError:
+    html_parser = 'html.parser'
+
+http_config = {'timeout': (5, 30),
+               'retries': 3,
+               'backoff': 0.5,
+               'pool_size': 10,
+               'offline': False}
+_session = None
+_cache = None
+_session_lock = threading.Lock()
+
+def configure_http(timeout=None, retries=None, backoff=None, pool_size=None):
+    """
+    Changes the settings of the shared HTTP session. timeout is in
+    seconds, either a float or a (connect, read) tuple. pool_size is
+    the number of keep-alive connections held per host.
+    Settings that are None are left unchanged.
+    """
+    global _session
+    for key, value in (('timeout', timeout),
+                       ('retries', retries),
+                       ('backoff', backoff),
+                       ('pool_size', pool_size)):
+        if value is not None:
+            http_config[key] = value
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+def get_session():
+    """
+    Returns the requests session that is shared by all collectors.
+    Connections are pooled per host and kept alive. Connection errors
+    and 5xx responses are retried with exponential backoff; 429
+    responses are left to http_get(), which honors Retry-After.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            return _session
+        retry = Retry(total=http_config['retries'],
+                      backoff_factor=http_config['backoff'],
+                      status_forcelist=(500, 502, 503, 504),
+                      respect_retry_after_header=False,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=http_config['pool_size'],
+                              pool_maxsize=http_config['pool_size'],
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        _session = session
+        return _session
+
+def configure_cache(filename, max_size=1024*1024*1024, offline=False):
+    """
+    Enables the on-disk response cache in the given file. If max_size
+    is 0, the cache is disabled. In offline mode, pages are served only
+    from the cache and never downloaded.
+    """
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = ResponseCache(filename, max_size) if max_size else None
+    http_config['offline'] = offline
+
+def _get_retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+def http_get(url, **kwargs):
+    """
+    Like requests.get(), but uses the shared session and the
+    configured timeout. The number of concurrent requests per host
+    is adapted by its HostLimiter; requests answered with 429 are
+    sent again after the delay requested by the host.
+    Raises SourceUnavailable if the host is down or keeps refusing.
+    """
+    kwargs.setdefault('timeout', http_config['timeout'])
+    host = urlparse(url).netloc
+    limiter = get_limiter(host)
+    for attempt in range(http_config['retries'] + 1):
+        limiter.acquire()
+        start = time.time()
+        try:
+            with stats.timer('http-latency', host):
+                response = get_session().get(url, **kwargs)
+        except Exception:
+            limiter.release('error')
+            stats.count('http-errors', host)
+            raise
+        stats.count('http-status', '{} {}'.format(host, response.status_code))
+        if response.status_code == 429:
+            limiter.release('throttled', retry_after=_get_retry_after(response))
+            continue
+        if response.status_code >= 500:
+            limiter.release('error')
+        else:
+            limiter.release('ok', time.time() - start)
+        stats.count('http-bytes', host, len(response.content))
+        return response
+    raise SourceUnavailable('{} keeps rate limiting requests'.format(host))
 
 def get_stocks_from_file(filename):
     with open(filename) as fp:
         return [l.rstrip() for l in fp.readlines()]
 
+def get_content_from_url(url):
+    """
+    Returns the body of the given URL as a (bytes, encoding) tuple.
+    If the response cache is enabled, a cached response is revalidated
+    using a conditional GET, and the cached body is returned if the
+    page did not change. An IOError is raised if the server responds
+    with an error, or, in offline mode, if the URL is not cached.
+    """
+    entry = _cache.get(url) if _cache is not None else None
+    if http_config['offline']:
+        if entry is None:
+            stats.count('http-cache', 'miss')
+            raise IOError('offline mode: {} is not cached'.format(url))
+        stats.count('http-cache', 'hit')
+        return entry['body'], entry['encoding']
+
+    headers = {}
+    if entry is not None and entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry is not None and entry['last-modified']:
+        headers['If-Modified-Since'] = entry['last-modified']
+    response = http_get(url, headers=headers)
+    if response.status_code == 304 and entry is not None:
+        stats.count('http-cache', 'not-modified')
+        return entry['body'], entry['encoding']
+    stats.count('http-cache', 'miss')
+    if not 200 <= response.status_code < 300:
+        # Error pages must not be parsed (and stored) as empty pages.
+        raise IOError('{} returned status {}'.format(url, response.status_code))
+    if _cache is not None and response.status_code == 200:
+        _cache.put(url,
+                   response.content,
+                   response.encoding,
+                   response.headers.get('ETag'),
+                   response.headers.get('Last-Modified'))
+    return response.content, response.encoding
+
 def download_from_url(url, filename, overwrite=False):
     if not overwrite and os.path.isfile(filename):
         return filename
-    request = requests.get(url)
+    body, encoding = get_content_from_url(url)
     with open(filename, 'wb') as fp:
-        for chunk in request.iter_content(chunk_size=1024):
-            if chunk:
-                fp.write(chunk)
+        fp.write(body)
     return filename
 
-def get_soup_from_url(url):
+def get_html_from_url(url):
+    """
+    Returns the body of the page at the given URL as a string.
+    """
+    body, encoding = get_content_from_url(url)
+    return body.decode(encoding or 'utf-8', 'replace')
+
+def make_soup(data_html, parse_only=None):
+    """
+    Parses the given HTML using the fastest available parser.
+    If parse_only is a tag name or a list of tag names, only those
+    elements are included in the tree.
     """
-    Returns the JSON from the given financialmodelingprep.com URL.
+    if parse_only is not None:
+        parse_only = SoupStrainer(parse_only)
+    return BeautifulSoup(data_html, html_parser, parse_only=parse_only)
+
+def get_soup_from_url(url, parse_only=None):
+    """
+    Returns the parsed HTML from the given URL.
+    """
+    return make_soup(get_html_from_url(url), parse_only)
+
+def get_label_index(soup):
+    """
+    Walks all table rows once and returns a dict mapping the label in
+    the first cell of each row to a list containing the text of the
+    remaining cells, e.g.::
+
+        {"Trailing P/E": ["12.5"]}
+
+    If a label appears more than once, the first row wins.
     """
-    request = requests.get(url)
-    data_html = request.text
-    return BeautifulSoup(data_html, 'html.parser')
+    index = {}
+    for row in soup.find_all('tr'):
+        cells = row.find_all('td', recursive=False)
+        if not cells:
+            continue
+        label = cells[0].find('span')
+        if label is None or label.string is None:
+            continue
+        values = []
+        for cell in cells[1:]:
+            span = cell.find('span')
+            values.append(span.text if span is not None else cell.text)
+        index.setdefault(label.string, values)
+    return index
 
 def resolve_value(value):
     """
@@ -31,7 +225,7 @@ def resolve_value(value):
     """
     if value is None:
         return None
-    tens = dict(k=10e3, m=10e6, b=10e9, t=10e12)
+    tens = dict(k=1e3, m=1e6, b=1e9, t=1e12)
     value = value.replace(',', '')
     match = re.match(r'(-?\d+\.?\d*)([kmbt]?)$', value, re.I)
     if not match:
@@ -1,160 +1,248 @@
+import json
+import time
 from datetime import datetime
 from itertools import islice
 from collections import OrderedDict
-from .util import get_soup_from_url, resolve_value
+from .util import get_content_from_url, get_html_from_url, make_soup, get_label_index, resolve_value
+from .stats import stats
 
 yahoo_key_stats_url = 'https://finance.yahoo.com/quote/%s/key-statistics/?guccounter=1'
 yahoo_income_statement_url = 'https://finance.yahoo.com/quote/%s/financials/'
 yahoo_balance_sheet_url = 'https://finance.yahoo.com/quote/%s/balance-sheet/'
 yahoo_analysis_url = 'https://finance.yahoo.com/quote/%s/analysis/'
+yahoo_json_state_marker = 'root.App.main = '
+
+def first_value(index, label):
+    """
+    Returns the text of the first value cell for the given label in a
+    label index, or None.
+    """
+    values = index.get(label)
+    if not values:
+        return None
+    return values[0]
+
+def find_market_price(soup):
+    """
+    Returns the stock price as a string. The price is only included in
+    the javascript, making extraction hairy...
+    """
+    for scr in soup.find_all('script'):
+        scr = scr.string
+        if not scr:
+            continue
+        try:
+            idx = scr.index('regularMarketPrice')
+            idx = idx + scr[idx:].index('"raw":')
+        except ValueError:
+            continue
+        length = scr[idx+6:].find(',')
+        return scr[idx+6:idx+6+length]
+    return None
+
+def get_quote_summary(data_html):
+    """
+    Finds the JSON state that Yahoo embeds into the javascript of each
+    quote page and returns the contained quote summary as a dict, or
+    None if the page has no such state.
+    """
+    idx = data_html.find(yahoo_json_state_marker)
+    if idx < 0:
+        return None
+    decoder = json.JSONDecoder()
+    try:
+        state, _ = decoder.raw_decode(data_html, idx+len(yahoo_json_state_marker))
+        return state['context']['dispatcher']['stores']['QuoteSummaryStore']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def raw_value(module, key):
+    """
+    Returns the number for the given key from a quote summary module,
+    e.g. 12.5 for {"trailingPE": {"raw": 12.5, "fmt": "12.50"}}.
+    """
+    try:
+        value = module[key]
+    except (KeyError, TypeError):
+        return None
+    if isinstance(value, dict):
+        return value.get('raw')
+    return value
+
+def key_stats_from_summary(summary, strict=True):
+    """
+    Returns the key statistics from the given quote summary. If strict
+    is True, None is returned if the summary does not contain them.
+    Otherwise, missing fields are None.
+    """
+    if not summary or 'defaultKeyStatistics' not in summary:
+        if strict:
+            return None
+        summary = {}
+    price = summary.get('price')
+    stats = summary.get('defaultKeyStatistics')
+    detail = summary.get('summaryDetail')
+    financial = summary.get('financialData')
+    return {'price': raw_value(price, 'regularMarketPrice'),
+            'total-debt': raw_value(financial, 'totalDebt'),
+            'total-debt-equity': raw_value(financial, 'debtToEquity'),
+            'pe-trailing': raw_value(detail, 'trailingPE'),
+            'pe-forward': raw_value(stats, 'forwardPE'),
+            'p-bv': raw_value(stats, 'priceToBook'),
+            'dividend-forward': raw_value(detail, 'dividendRate'),
+            'current-ratio': raw_value(financial, 'currentRatio')}
+
+def income_statement_from_summary(summary, strict=True):
+    try:
+        history = summary['incomeStatementHistory']['incomeStatementHistory']
+    except (KeyError, TypeError):
+        if strict:
+            return None
+        history = []
+    ni = OrderedDict()
+    for statement in history:
+        end_date = statement.get('endDate') or {}
+        date = end_date.get('fmt')
+        if date is None and end_date.get('raw') is not None:
+            date = datetime.utcfromtimestamp(end_date['raw']).strftime('%Y-%m-%d')
+        if date is None:
+            continue
+        ni[date] = raw_value(statement, 'netIncomeApplicableToCommonShares')
+    latest = history[0] if history else None
+    return {'net-income': ni,
+            'total-revenue': raw_value(latest, 'totalRevenue'),
+            'gross-profit': raw_value(latest, 'grossProfit')}
+
+def balance_sheet_from_summary(summary, strict=True):
+    try:
+        history = summary['balanceSheetHistory']['balanceSheetStatements']
+    except (KeyError, TypeError):
+        if strict:
+            return None
+        history = []
+    latest = history[0] if history else None
+    return {'total-assets': raw_value(latest, 'totalAssets')}
+
+def key_stats_from_html(data_html):
+    soup = make_soup(data_html, parse_only=['tr', 'script'])
+    index = get_label_index(soup)
+    return {'price': resolve_value(find_market_price(soup)),
+            'total-debt': resolve_value(first_value(index, 'Total Debt')),
+            'total-debt-equity': resolve_value(first_value(index, 'Total Debt/Equity')),
+            'pe-trailing': resolve_value(first_value(index, 'Trailing P/E')),
+            'pe-forward': resolve_value(first_value(index, 'Forward P/E')),
+            'p-bv': resolve_value(first_value(index, 'Price/Book')),
+            'dividend-forward': resolve_value(first_value(index, 'Forward Annual Dividend Rate')),
+            'current-ratio': resolve_value(first_value(index, 'Current Ratio'))}
+
+def income_statement_from_html(data_html):
+    soup = make_soup(data_html, parse_only='tr')
+    index = get_label_index(soup)
+
+    # Extract dates for each year.
+    dates = []
+    for text in index.get('Revenue', []):
+        date = datetime.strptime(text, "%m/%d/%Y").strftime('%Y-%m-%d')
+        dates.append(date)
+
+    # Annual net income. All numbers on the page are in thousands.
+    ni = OrderedDict()
+    ni_values = index.get('Net Income Applicable To Common Shares', [])
+    for date, text in zip(dates, ni_values):
+        ni[date] = resolve_value(text + 'k')
+
+    # Total revenue and gross profit.
+    tre = first_value(index, 'Total Revenue')
+    gp = first_value(index, 'Gross Profit')
+
+    return {'net-income': ni,
+            'total-revenue': resolve_value(tre + 'k' if tre else '-'),
+            'gross-profit': resolve_value(gp + 'k' if gp else '-')}
+
+def balance_sheet_from_html(data_html):
+    soup = make_soup(data_html, parse_only='tr')
+    index = get_label_index(soup)
+    ta = first_value(index, 'Total Assets')
+    return {'total-assets': resolve_value(ta + 'k' if ta else '-')}
+
+# Maps each page to its parsers for the JSON state and for the HTML.
+pages = {'key-stats': (key_stats_from_summary, key_stats_from_html),
+         'income-statement': (income_statement_from_summary, income_statement_from_html),
+         'balance-sheet': (balance_sheet_from_summary, balance_sheet_from_html)}
+
+def timed_parse_page(page, body, encoding=None, mode='auto'):
+    """
+    Parses the given page (see pages) from the raw response body.
+    Returns the parsed dict and the time spent in seconds. Only takes
+    and returns plain data, so it can run in a worker process.
+    """
+    start = time.perf_counter()
+    from_summary, from_html = pages[page]
+    if isinstance(body, bytes):
+        body = body.decode(encoding or 'utf-8', 'replace')
+    result = None
+    if mode != 'html':
+        result = from_summary(get_quote_summary(body), strict=mode != 'json')
+    if result is None:
+        result = from_html(body)
+    return result, time.perf_counter() - start
+
+def parse_page(page, body, encoding=None, mode='auto'):
+    """
+    Like timed_parse_page(), but only returns the parsed dict.
+    """
+    result, seconds = timed_parse_page(page, body, encoding, mode)
+    stats.add_time('parse', 'yahoo-' + page, seconds)
+    return result
 
 class YahooCompany(object):
-    def __init__(self, symbol):
+    """
+    mode is one of:
+
+    - 'json': read all fields from the JSON state embedded in the page
+    - 'html': scrape all fields from the HTML tables
+    - 'auto': use the JSON state where available, HTML otherwise
+
+    parser is called as parser(page, body, encoding, mode) to parse
+    each downloaded page; it defaults to parse_page(), which parses in
+    the calling thread.
+    """
+    def __init__(self, symbol, mode='auto', parser=None):
         self.symbol = symbol
+        self.mode = mode
+        self.parser = parser or parse_page
         self._yahoo_key_stats = None
         self._yahoo_income_statement = None
         self._yahoo_balance_sheet = None
         self._yahoo_analysis = None
 
+    def _get_page(self, page, url):
+        body, encoding = get_content_from_url(url % self.symbol)
+        return self.parser(page, body, encoding, self.mode)
+
     @property
     def yahoo_key_stats(self):
-        if self._yahoo_key_stats is not None:
-            return self._yahoo_key_stats
-        soup = get_soup_from_url(yahoo_key_stats_url % self.symbol)
-
-        # The stock price is only included in the javascript, making extraction hairy...
-        price = None
-        for n, scr in enumerate(soup.find_all('script')):
-            scr = scr.string
-            if not scr:
-                continue
-            try:
-                idx = scr.index('regularMarketPrice')
-                idx = idx + scr[idx:].index('"raw":')
-            except ValueError:
-                continue
-            length = scr[idx+6:].find(',')
-            price = scr[idx+6:idx+6+length]
-
-        pet_label = soup.find("span", string="Trailing P/E")
-        pef_label = soup.find("span", string="Forward P/E")
-        pbv_label = soup.find("span", string="Price/Book")
-        td_label = soup.find("span", string="Total Debt")
-        tde_label = soup.find("span", string="Total Debt/Equity")
-        fw_dividend_label = soup.find("span", string="Forward Annual Dividend Rate")
-        cr_label = soup.find("span", string="Current Ratio")
-        try:
-            total_debt = td_label.parent.nextSibling.text
-        except AttributeError:
-            total_debt = None
-        try:
-            total_debt_equity = tde_label.parent.nextSibling.text
-        except AttributeError:
-            total_debt_equity = None
-        try:
-            pe_trailing = pet_label.parent.nextSibling.text
-        except AttributeError:
-            pe_trailing = None
-        try:
-            pe_forward = pef_label.parent.nextSibling.text
-        except AttributeError:
-            pe_forward = None
-        try:
-            pbv = pbv_label.parent.nextSibling.text
-        except AttributeError:
-            pbv = None
-        try:
-            dividend_forward = fw_dividend_label.parent.nextSibling.text
-        except AttributeError:
-            dividend_forward = None
-        try:
-            cr = cr_label.parent.nextSibling.text
-        except AttributeError:
-            cr = None
-        result = {'price': resolve_value(price),
-                  'total-debt': resolve_value(total_debt),
-                  'total-debt-equity': resolve_value(total_debt_equity),
-                  'pe-trailing': resolve_value(pe_trailing),
-                  'pe-forward': resolve_value(pe_forward),
-                  'p-bv': resolve_value(pbv),
-                  'dividend-forward': resolve_value(dividend_forward),
-                  'current-ratio': resolve_value(cr)}
-        self._yahoo_key_stats = result
+        if self._yahoo_key_stats is None:
+            self._yahoo_key_stats = self._get_page('key-stats', yahoo_key_stats_url)
         return self._yahoo_key_stats
 
     @property
     def yahoo_income_statement(self):
-        if self._yahoo_income_statement is not None:
-            return self._yahoo_income_statement
-        soup = get_soup_from_url(yahoo_income_statement_url % self.symbol)
-
-        # Find some entry points in the HTML.
-        re_label = soup.find("span", string="Revenue")
-        try:
-            re_spans = re_label.parent.parent.select('td > span')[1:]
-        except AttributeError:
-            re_spans = []
-
-        ni_label = soup.find("span", string="Net Income Applicable To Common Shares")
-        try:
-            ni_spans = ni_label.parent.parent.select('td > span')[1:]
-        except AttributeError:
-            ni_spans = []
-
-        tre_label = soup.find("span", string="Total Revenue")
-        gp_label = soup.find("span", string="Gross Profit")
-
-        # Extract dates for each year.
-        dates = []
-        for span in re_spans:
-            date = datetime.strptime(span.text, "%m/%d/%Y").strftime('%Y-%m-%d')
-            dates.append(date)
-
-        # Annual net income.
-        try:
-            ni = OrderedDict()
-            for date, span in zip(dates, ni_spans):
-                ni[date] = resolve_value(span.text)
-        except AttributeError:
-            print(" !Warning: failed to look up net income for %s" % date)
-
-        # Total revenue.
-        try:
-            tre = tre_label.parent.nextSibling.find('span').text + 'k'
-        except AttributeError:
-            tre = '-'
-
-        # Gross profit.
-        try:
-            gp = gp_label.parent.nextSibling.find('span').text + 'k'
-        except AttributeError:
-            gp = '-'
-
-        result = {'net-income': ni,
-                  'total-revenue': resolve_value(tre),
-                  'gross-profit': resolve_value(gp)}
-        self._yahoo_income_statement = result
+        if self._yahoo_income_statement is None:
+            self._yahoo_income_statement = self._get_page('income-statement', yahoo_income_statement_url)
         return self._yahoo_income_statement
 
     @property
     def yahoo_balance_sheet(self):
-        if self._yahoo_balance_sheet is not None:
-            return self._yahoo_balance_sheet
-        soup = get_soup_from_url(yahoo_balance_sheet_url % self.symbol)
-        ta_label = soup.find("span", string="Total Assets")
-        try:
-            ta = ta_label.parent.nextSibling.find('span').text + 'k'
-        except AttributeError:
-            ta = '-'
-        result = {'total-assets': resolve_value(ta)}
-        self._yahoo_balance_sheet = result
+        if self._yahoo_balance_sheet is None:
+            self._yahoo_balance_sheet = self._get_page('balance-sheet', yahoo_balance_sheet_url)
         return self._yahoo_balance_sheet
 
     @property
     def yahoo_analysis(self):
         if self._yahoo_analysis is not None:
             return self._yahoo_analysis
-        soup = get_soup_from_url(yahoo_analysis_url % self.symbol)
+        soup = make_soup(get_html_from_url(yahoo_analysis_url % self.symbol))
         result = {}
         self._yahoo_analysis = result
         return self._yahoo_analysis
@@ -217,7 +305,7 @@ class YahooCompany(object):
         try:
             ni = next(islice(self.yahoo_income_statement.get('net-income').values(), 1))
             return int(ni)
-        except (KeyError, ValueError, StopIteration):
+        except (KeyError, TypeError, ValueError, StopIteration):
             return None
 
     def get_net_income_series(self):
@@ -231,9 +319,11 @@ class YahooCompany(object):
         if not ni:
             return None
         try:
-            return dict((k, int(v)) for (k, v) in ni.items())
+            # Years that Yahoo has no number for are left out.
+            series = dict((k, int(v)) for (k, v) in ni.items() if v is not None)
         except ValueError:
             return None
+        return series or None
 
     @property
     def revenue(self):
@@ -2,69 +2,510 @@
 import os
 import sys
 import json
+import time
+import atexit
+import threading
 from argparse import ArgumentParser
-from collect.util import get_stocks_from_file
-from collect.nasdaq import get_nasdaq_traded_stocks, get_nasdaq_listed_stocks
-from collect.fmp import FmpCompany
-from collect.yahoo import YahooCompany
-from analytics.graham import graham_filter
+from collect.pages import page_names, optional_page_names, parse_duration, parse_ttl, \
+        get_expired_pages
+from collect.nasdaq import directories
+from collect.stats import stats
 
+# Subcommands import the modules they need when they run, and the data
+# directory is only created when it is used, so that "--help" and "dir"
+# start quickly. The store and the history may first be used by the
+# download threads, so they are created under a lock. The parse pool
+# is started by setup_http(), before the download threads.
 data_dir = os.path.join(os.path.dirname(__file__), 'data')
-if not os.path.isdir(data_dir):
-    os.makedirs(data_dir)
-
-def fetch_symbol_data(symbol):
-    """
-    Retrieve the data for the given symbol from Yahoo and FMP.
-    """
-    fmp_company = FmpCompany(symbol)
-    yahoo_company = YahooCompany(symbol)
-    return {'symbol': symbol,
-            'rating': fmp_company.rating,
-            'share-price': yahoo_company.share_price,
-            'total-debt': yahoo_company.total_debt,
-            'total-debt-equity': yahoo_company.total_debt_equity,
-            'pe-trailing': yahoo_company.pe_trailing,
-            'pe-forward': yahoo_company.pe_forward,
-            'p-bv': yahoo_company.p_bv,
-            'dividend-forward': yahoo_company.dividend_forward,
-            'current-ratio': yahoo_company.current_ratio,
-            'latest-net-income': yahoo_company.net_income,
-            'net-income': yahoo_company.get_net_income_series(),
-            'total-revenue': yahoo_company.revenue,
-            'gross-profit': yahoo_company.gross_profit,
-            'total-assets': yahoo_company.total_assets}
-
-def pull(symbol):
-    """
-    Like fetch(), but also stores the result on the file system.
-    """
-    company = fetch_symbol_data(symbol)
-    filename = os.path.join(data_dir, symbol + '.json')
-    with open(filename, 'w') as fp:
-        json.dump(company, fp)
+_init_lock = threading.RLock()
+_store = None
+_history = None
+_parse_pool = None
+_symbol_index = None
+parse_workers = 0
+
+def get_data_dir(*subdirs):
+    """
+    Returns the path of the data directory (or the given subdirectory),
+    creating it if needed.
+    """
+    path = os.path.join(data_dir, *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def get_store():
+    global _store
+    with _init_lock:
+        if _store is not None:
+            return _store
+        from store.company import CompanyStore
+        store = CompanyStore(os.path.join(get_data_dir(), 'stocklist.db'))
+        store.migrate_json_dir(data_dir)
+        _store = store
+        return _store
+
+def get_history():
+    """
+    Returns the snapshot history, which receives a snapshot of every
+    pulled company. Buffered snapshots are written at exit.
+    """
+    global _history
+    with _init_lock:
+        if _history is not None:
+            return _history
+        from store.history import SnapshotHistory
+        _history = SnapshotHistory(get_data_dir('history'))
+        atexit.register(_history.flush)
+        return _history
+
+def get_parser():
+    """
+    Returns the function that parses downloaded pages: the parse()
+    method of a process pool if --parse-workers was given, or None
+    to parse in the downloading threads.
+    """
+    global _parse_pool
+    if not parse_workers:
+        return None
+    with _init_lock:
+        if _parse_pool is None:
+            from collect.fetch import ParsePool
+            _parse_pool = ParsePool(parse_workers)
+            atexit.register(_parse_pool.close)
+        return _parse_pool.parse
+
+def setup_http(args):
+    """
+    Configures the HTTP session and response cache from the global
+    command line options.
+    """
+    from collect.util import configure_http, configure_cache
+    from collect.limiter import configure_limits
+    configure_http(timeout=args.timeout,
+                   retries=args.retries,
+                   pool_size=max(10, getattr(args, 'jobs', 1) * 4))
+    configure_limits(maximum=args.max_per_host)
+    configure_cache(os.path.join(get_data_dir(), 'http-cache.db'),
+                    max_size=args.cache_size*1024*1024,
+                    offline=args.offline)
+    # Start the parse pool before any download thread exists.
+    get_parser()
+
+def get_symbol_index():
+    global _symbol_index
+    if _symbol_index is not None:
+        return _symbol_index
+    from store.symbols import SymbolIndex
+    _symbol_index = SymbolIndex(os.path.join(get_data_dir(), 'symbols.db'))
+    return _symbol_index
+
+def get_symbol_filter(args):
+    from store.symbols import SymbolFilter
+    return SymbolFilter(exclude_etf=args.no_etf,
+                        exclude_test_issues=args.no_test_issues,
+                        normal_status=args.normal_status,
+                        exchanges=args.exchange)
+
+def filter_symbols(symbols, symbol_filter):
+    """
+    Returns the given symbols that pass the given SymbolFilter according
+    to the symbol index, see SymbolIndex.filter().
+    """
+    if not symbol_filter:
+        return symbols
+    index = get_symbol_index()
+    if not len(index):
+        sys.stderr.write('warning: the symbol index is empty, run "dir" to fill it\n')
+    return index.filter(symbols, symbol_filter)
+
+def read_symbol_files(filenames):
+    from collect.util import get_stocks_from_file
+    symbols = []
+    for filename in filenames:
+        try:
+            symbols += get_stocks_from_file(filename)
+        except OSError as e:
+            parser.error(e)
+    return symbols
+
+def read_symbols(args):
+    """
+    Returns the symbols from the command line, followed by those in
+    the files given with --filename, without duplicates. Symbols in the
+    files given with --exclude, and those that do not pass the filter
+    options (if the command has them), are removed.
+    """
+    symbols = list(dict.fromkeys(args.symbols + read_symbol_files(args.filename)))
+    excluded = set(read_symbol_files(getattr(args, 'exclude', [])))
+    if excluded:
+        symbols = [symbol for symbol in symbols if symbol not in excluded]
+    if hasattr(args, 'no_etf'):
+        symbols = filter_symbols(symbols, get_symbol_filter(args))
+    return symbols
+
+def read_symbols_or_all(args):
+    """
+    Like read_symbols(), but returns None (meaning all symbols) if no
+    symbols and no --filename were given. If symbols were given but all
+    of them were removed, the result is an empty list.
+    """
+    if not args.symbols and not args.filename:
+        return None
+    return read_symbols(args)
+
+def iter_directory(source, max_age=None, symbol_filter=None):
+    """
+    Yields the symbols of the given NASDAQ directory that pass the given
+    SymbolFilter, while it is downloaded. Once the directory was read
+    completely, its rows replace those in the symbol index.
+    """
+    from collect.nasdaq import iter_nasdaq_rows
+    filename, column = directories[source]
+    rows = []
+    for row in iter_nasdaq_rows(filename, get_data_dir('nasdaq'), max_age):
+        rows.append(row)
+        if not symbol_filter or symbol_filter.matches(row):
+            yield row['symbol']
+        else:
+            stats.count('symbols', 'filtered')
+    get_symbol_index().update(source, rows)
+
+def pull(symbol, parallel=False, pages=None, company=None, fmp_batch=None, history=True):
+    """
+    Like fetch(), but also stores the result in the store, and appends
+    a snapshot to the history unless history is False.
+    If pages is given, only these pages are fetched and their fields
+    are merged into the given company.
+    """
+    from collect.fetch import fetch_symbol_data, fetched_pages
+    if pages is None:
+        pages = page_names
+    data = fetch_symbol_data(symbol, parallel, pages, fmp_batch, get_parser())
+    if company is not None:
+        company = dict(company)
+        company.update(data)
+    else:
+        company = data
+    get_store().save(company, fetched_pages(pages, data))
+    if history:
+        get_history().append(company)
+    return company
+
+def load(symbol, parallel=False):
+    """
+    Like pull(), but uses already stored version from the store,
+    if available. Pages of the stored company that were never fetched
+    (e.g. by a staged screen) are fetched and merged into it.
+    """
+    store = get_store()
+    company = store.load(symbol)
+    if company is None:
+        stats.count('store', 'miss')
+        return pull(symbol, parallel)
+    fetched = store.load_freshness([symbol]).get(symbol, {})
+    missing = [page for page in page_names if page not in fetched]
+    if missing:
+        stats.count('store', 'expired')
+        return pull(symbol, parallel, missing, company)
+    stats.count('store', 'hit')
     return company
 
-def load(symbol):
+def fetch_all(symbols, force=False, jobs=1, ttl=None, pages=page_names):
+    """
+    Like load() (or pull(), if force is True) for all given symbols.
+    Stored companies are read in bulk. If ttl is given, pages of a
+    stored company that are older than their time to live are fetched
+    again.
+    Yields (symbol, company, error) tuples in the order of the input,
+    except for symbols that were deferred because a source was
+    unavailable (see defer_unavailable()); they come last.
+    """
+    results = _fetch_all(symbols, force, jobs, ttl, pages)
+    return defer_unavailable(results, lambda s: _fetch_all(s, force, jobs, ttl, pages))
+
+def _fetch_all(symbols, force=False, jobs=1, ttl=None, pages=page_names):
+    from collect.fetch import map_ordered
+    from collect.fmp import FmpBatch
+    store = get_store()
+    cached = {} if force else store.load_many(symbols)
+    freshness = store.load_freshness(symbols) if cached else {}
+    parallel = jobs > 1
+
+    # Decide up front which pages each symbol needs, so that FMP ratings
+    # and Stockrow statements can be fetched in bulk. Pages that were
+    # never fetched (e.g. by a staged screen) are always needed.
+    todo = {}
+    for symbol in symbols:
+        if symbol not in cached:
+            todo[symbol] = pages
+            continue
+        fetched = freshness.get(symbol, {})
+        if ttl is not None:
+            expired = get_expired_pages(fetched, ttl, pages=pages)
+        else:
+            expired = [page for page in pages if page not in fetched]
+        if expired:
+            todo[symbol] = expired
+    rating_symbols = [s for s in todo if 'fmp-rating' in todo[s]]
+    fmp_batch = FmpBatch(rating_symbols) if len(rating_symbols) > 1 else None
+    stockrow_symbols = [s for s in todo if 'stockrow' in todo[s]]
+    if stockrow_symbols:
+        from collect.stockrow import ingest
+        for symbol, error in ingest(stockrow_symbols, True, jobs, names=['balance_sheet']):
+            stats.count('stockrow', 'failed')
+            # Do not request it again; it is fetched by a later run.
+            todo[symbol] = [page for page in todo[symbol] if page != 'stockrow']
+            if not todo[symbol]:
+                del todo[symbol]
+
+    def fetch(symbol):
+        company = cached.get(symbol)
+        if company is None:
+            stats.count('store', 'miss')
+            return pull(symbol, parallel, todo[symbol], fmp_batch=fmp_batch)
+        if symbol not in todo:
+            stats.count('store', 'hit')
+            return company
+        stats.count('store', 'expired')
+        return pull(symbol, parallel, todo[symbol], company, fmp_batch)
+    return map_ordered(fetch, symbols, jobs)
+
+def defer_unavailable(results, retry, rounds=3, deadline=None, skip=None):
+    """
+    Passes on the (symbol, company, error) tuples of the given results,
+    except for symbols that failed because the circuit breaker of a
+    source was open. Once all sources are available again, these are
+    retried by calling retry(symbols), up to the given number of rounds.
+    retry must not defer symbols itself, or the rounds never run out.
+    If the sources only recover after the given deadline, the deferred
+    symbols are passed to skip(symbols) instead.
+    """
+    from collect.limiter import SourceUnavailable, unavailable_for
+    deferred = []
+    for symbol, company, error in results:
+        if isinstance(error, SourceUnavailable) and rounds > 0:
+            stats.count('symbols', 'deferred')
+            deferred.append(symbol)
+            continue
+        yield symbol, company, error
+    if not deferred:
+        return
+    delay = unavailable_for()
+    if deadline is not None and time.time() + delay >= deadline:
+        skip(deferred)
+        return
+    if delay:
+        sys.stderr.write('{} symbols deferred, waiting {:.0f}s for the sources to recover\n'.format(
+            len(deferred), delay))
+        time.sleep(delay)
+    for result in defer_unavailable(retry(deferred), retry, rounds-1, deadline, skip):
+        yield result
+
+def refresh(ranked, jobs=1, budget=None, max_requests=None, skipped=None):
+    """
+    Pulls the expired pages of the given (symbol, score, pages) tuples
+    (see rank_symbols()) in order, until the time budget (in seconds)
+    has passed or max_requests requests were made. Every page counts
+    as one request, so FMP ratings, which are fetched in batches, make
+    this an upper bound. Symbols that are still in flight when the
+    budget runs out are finished. Symbols that were deferred because a
+    source was unavailable go through the same budget when retried.
+    Yields (symbol, company, error) tuples for the fetched symbols, and
+    appends the (symbol, score, pages) tuples of the others to skipped.
+    """
+    from collect.fetch import map_ordered
+    from collect.fmp import FmpBatch
+    store = get_store()
+    parallel = jobs > 1
+    deadline = None if budget is None else time.time() + budget
+    todo = dict((symbol, pages) for symbol, score, pages in ranked)
+    rating_symbols = [s for s, score, pages in ranked if 'fmp-rating' in pages]
+    fmp_batch = FmpBatch(rating_symbols) if len(rating_symbols) > 1 else None
+    entries = dict((entry[0], entry) for entry in ranked)
+    if skipped is None:
+        skipped = []
+    requests = 0
+
+    def budgeted(entries):
+        nonlocal requests
+        for n, (symbol, score, pages) in enumerate(entries):
+            if (deadline is not None and time.time() >= deadline) \
+                    or (max_requests is not None and requests + len(pages) > max_requests):
+                skipped.extend(entries[n:])
+                return
+            requests += len(pages)
+            yield symbol
+
+    def fetch(symbol):
+        company = store.load(symbol)
+        stats.count('refresh', 'expired' if company else 'new')
+        return pull(symbol, parallel, todo[symbol], company, fmp_batch)
+    results = map_ordered(fetch, budgeted(ranked), jobs)
+    retry = lambda symbols: map_ordered(fetch, budgeted([entries[s] for s in symbols]), jobs)
+    skip = lambda symbols: skipped.extend(entries[s] for s in symbols)
+    return defer_unavailable(results, retry, deadline=deadline, skip=skip)
+
+def fetch_staged(symbol, force=False, ttl=None, fmp_batch=None):
+    """
+    Like load(), but fetches the pages of the company one at a time,
+    cheapest first, and stops as soon as the data shows that the
+    company fails the Graham screen. Every page is stored when it
+    arrives, so later runs only fetch the pages that are missing.
+    Returns the company and the list of criteria that it failed early
+    (empty if all pages were fetched). One snapshot of the company is
+    appended to the history once it is done, not one per page.
+    """
+    from analytics.screen import early_rejections
+    store = get_store()
+    company = None if force else store.load(symbol)
+    freshness = {}
+    if company is not None:
+        freshness = store.load_freshness([symbol]).get(symbol, {})
+    fetched = []
+    failed = []
+    pulled = False
+    try:
+        for page in page_names:
+            if company is None \
+                    or page not in freshness \
+                    or (ttl is not None and get_expired_pages(freshness, ttl, pages=[page])):
+                stats.count('staged', page)
+                company = pull(symbol, False, [page], company, fmp_batch, history=False)
+                pulled = True
+            fetched.append(page)
+            failed = early_rejections(company, fetched)
+            if failed:
+                break
+    finally:
+        if pulled:
+            get_history().append(company)
+    return company, failed
+
+def print_early_rejection(symbol, failed):
+    print('\n{}:\n -> Failed early ({}), remaining pages not fetched'.format(
+        symbol, ', '.join(failed)))
+
+def get_queue(args):
+    from store.queue import WorkQueue
+    filename = args.queue or os.path.join(get_data_dir(), 'queue.db')
+    return WorkQueue(filename)
+
+def run_worker(queue, job, jobs=1, lease=600, max_attempts=3):
     """
-    Like pull(), but uses already stored version from file system,
-    if available.
+    Pulls the symbols of the given job from the work queue until no
+    symbol is left, using the pages and options that the job was
+    created with. Each symbol is acknowledged as soon as it is
+    stored, so an interrupted worker only loses its current lease.
+    Symbols are not deferred while claimed: if a source is unavailable,
+    they count as failed attempts, and the worker waits for the source
+    to recover before it claims more, without holding any lease.
+    Yields (symbol, error) tuples.
     """
-    filename = os.path.join(data_dir, symbol + '.json')
-    if not os.path.isfile(filename):
-        return pull(symbol)
-    with open(filename) as fp:
-        return json.load(fp)
+    import socket
+    from collect.limiter import SourceUnavailable, unavailable_for
+    options = queue.get_options(job)
+    if options is None:
+        raise ValueError('unknown job: ' + repr(job))
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    pages = tuple(options.get('pages', page_names))
+    while True:
+        symbols = queue.claim(job, worker, max(10, jobs*10), lease)
+        if not symbols:
+            break
+        results = _fetch_all(symbols, options.get('force', False), jobs, options.get('ttl'), pages)
+        unavailable = False
+        for symbol, company, error in results:
+            if error is None:
+                queue.ack(job, symbol)
+            else:
+                queue.fail(job, symbol, error, max_attempts)
+                unavailable |= isinstance(error, SourceUnavailable)
+            yield symbol, error
+        delay = unavailable_for() if unavailable else 0
+        if delay:
+            sys.stderr.write('waiting {:.0f}s for the sources to recover\n'.format(delay))
+            time.sleep(delay)
+
+def write_stats(filename):
+    """
+    Writes the collected instrumentation data as JSON to the given
+    file, or to stderr if filename is "-".
+    """
+    from collect.limiter import get_limiter_states
+    report = stats.report()
+    report['host-limits'] = get_limiter_states()
+    if filename == '-':
+        json.dump(report, sys.stderr, indent=2)
+        sys.stderr.write('\n')
+        return
+    with open(filename, 'w') as fp:
+        json.dump(report, fp, indent=2)
+
+def start_profiler(filename):
+    """
+    Profiles the main thread until exit and writes the result to
+    the given file, for use with pstats or snakeviz.
+    """
+    import cProfile
+    profiler = cProfile.Profile()
+    atexit.register(profiler.dump_stats, filename)
+    atexit.register(profiler.disable)
+    profiler.enable()
+
+def add_filter_arguments(subparser, exclude=True):
+    """
+    Adds the options that filter symbols by the symbol index.
+    """
+    subparser.add_argument('--no-etf', action='store_true',
+                           help='skip ETFs')
+    subparser.add_argument('--no-test-issues', action='store_true',
+                           help='skip test issues')
+    subparser.add_argument('--normal-status', action='store_true',
+                           help='skip companies that are deficient, delinquent or bankrupt')
+    subparser.add_argument('--exchange', type=str, action='append', default=None, metavar='CODE',
+                           help='only symbols listed on this exchange (may be repeated), e.g. '
+                                'Q (NASDAQ), N (NYSE), A (NYSE MKT), P (NYSE ARCA), Z (BATS)')
+    if exclude:
+        subparser.add_argument('--exclude', type=str, nargs='*', default=[], metavar='FILE',
+                               help='file containing a list of stock symbols to skip')
 
 # Parse command line options.
 parser = ArgumentParser()
+parser.add_argument('--timeout', type=float, default=30,
+                    help='HTTP timeout in seconds')
+parser.add_argument('--retries', type=int, default=3,
+                    help='number of retries for failed HTTP requests')
+parser.add_argument('--max-per-host', type=int, default=32,
+                    help='upper limit for the number of concurrent requests per host; '
+                         'the actual limit adapts to how the host responds')
+parser.add_argument('--parse-workers', type=int, default=0, metavar='N',
+                    help='parse pages in N worker processes instead of the download '
+                         'threads (default: 0)')
+parser.add_argument('--offline', action='store_true',
+                    help='serve all pages from the HTTP cache, never download')
+parser.add_argument('--cache-size', type=int, default=1024,
+                    help='maximum size of the HTTP cache in MB (0 to disable)')
+parser.add_argument('--stats', type=str, default=None, metavar='FILE',
+                    help='write latency histograms and cache statistics as JSON to FILE ("-" for stderr)')
+parser.add_argument('--profile', type=str, default=None, metavar='FILE',
+                    help='write cProfile data of the run to FILE (use --jobs 1 to include fetching)')
+parser.add_argument('--queue', type=str, default=None, metavar='FILE',
+                    help='the work queue used by "pull --job", "worker" and "status" '
+                         '(default: data/queue.db)')
 subparsers = parser.add_subparsers(dest="action", title='Subcommands')
 
 # "dir" command.
 dir_parser = subparsers.add_parser('dir',
                                    help='get a list of stock symbols')
+dir_parser.add_argument('--max-age', type=str, default=None,
+                        help='use the cached list if it is younger than this, e.g. 12h')
+dir_parser.add_argument('--new', action='store_true',
+                        help='only print symbols that were added since the previous download')
+dir_parser.add_argument('--delisted', action='store_true',
+                        help='only print symbols that were removed since the previous download')
+add_filter_arguments(dir_parser, exclude=False)
 dir_parser.add_argument('source', type=str,
-                        choices=('nasdaq-traded', 'nasdaq-listed'),
+                        choices=sorted(directories),
                         help='the name of the list')
 
 # "pull" command.
@@ -76,6 +517,21 @@ pull_parser.add_argument('-f', '--force',
                          dest='force',
                          action='store_true',
                          help='Overwrite existing data')
+pull_parser.add_argument('--ttl', type=str, action='append', default=[],
+                         metavar='PAGE=DURATION',
+                         help='maximum age of a page before it is fetched again, '
+                              'e.g. key-stats=12h. Pages: ' + ', '.join(page_names + optional_page_names))
+pull_parser.add_argument('--stockrow', action='store_true',
+                         help='also fetch the balance sheet history from Stockrow')
+pull_parser.add_argument('-j', '--jobs', type=int, default=1,
+                         help='number of symbols to fetch in parallel')
+pull_parser.add_argument('--job', type=str, default=None, metavar='NAME',
+                         help='add the symbols to the named job in the work queue and '
+                              'work on it; running the same command again resumes the job')
+pull_parser.add_argument('--shard', type=str, default=None, metavar='K/N',
+                         help='with --job, only add the K-th of N parts of the symbol list, '
+                              'e.g. 2/4, to spread a job across N hosts')
+add_filter_arguments(pull_parser)
 pull_parser.add_argument('symbols', type=str, nargs='*',
                          help='one or more stock symbols')
 
@@ -91,59 +547,432 @@ graham_parser.add_argument('-f', '--force',
 graham_parser.add_argument('-v', '--verbose', type=int,
                            default=1, choices=range(1,6),
                            help='verbosity level (1 to 5)')
+graham_parser.add_argument('--batch', action='store_true',
+                           help='screen all symbols at once and print one line per symbol')
+graham_parser.add_argument('-j', '--jobs', type=int, default=1,
+                           help='number of symbols to fetch in parallel')
+graham_parser.add_argument('--staged', action='store_true',
+                           help='fetch one page at a time and skip the remaining pages '
+                                'of companies that already failed')
+graham_parser.add_argument('--incremental', action='store_true',
+                           help='screen the stored data, only re-evaluating companies that '
+                                'changed since the previous run')
+graham_parser.add_argument('--changes', action='store_true',
+                           help='like --incremental, but only print the symbols that '
+                                'newly pass or newly fail')
+graham_parser.add_argument('--as-of', type=str, default=None, metavar='DATE',
+                           help='screen the latest snapshots taken on or before DATE '
+                                '(YYYY-MM-DD) instead of fetching; all symbols by default')
+add_filter_arguments(graham_parser)
 graham_parser.add_argument('symbols', type=str, nargs='*',
                            help='one or more stock symbols')
 
+# "screen" command.
+screen_parser = subparsers.add_parser('screen',
+        help='stream a symbol list through the Graham filter')
+screen_parser.add_argument('--source', type=str, required=True,
+                           choices=sorted(directories),
+                           help='the name of the symbol list')
+screen_parser.add_argument('--max-age', type=str, default=None,
+                           help='use the cached symbol list if it is younger than this, e.g. 12h')
+screen_parser.add_argument('-f', '--force',
+                           dest='force',
+                           action='store_true',
+                           help='Overwrite existing data')
+screen_parser.add_argument('-v', '--verbose', type=int,
+                           default=1, choices=range(1,6),
+                           help='verbosity level (1 to 5)')
+screen_parser.add_argument('-j', '--jobs', type=int, default=4,
+                           help='number of symbols to fetch in parallel')
+screen_parser.add_argument('--staged', action='store_true',
+                           help='fetch one page at a time and skip the remaining pages '
+                                'of companies that already failed')
+add_filter_arguments(screen_parser, exclude=False)
+
+# "export" command.
+export_parser = subparsers.add_parser('export',
+        help='export the stored companies to CSV or memory-mappable .npy columns')
+export_parser.add_argument('--format', type=str, default='csv', choices=('csv', 'npy'),
+                           help='csv: one file; npy: a directory containing one .npy '
+                                'file per field (default: csv)')
+export_parser.add_argument('--fields', type=str, default=None,
+                           help='comma-separated list of the fields to export (default: all)')
+export_parser.add_argument('--filename', type=str, action='append', default=[],
+                           help='file containing a list of stock symbols (may be repeated)')
+export_parser.add_argument('--symbols', type=lambda value: [s.strip() for s in value.split(',') if s.strip()],
+                           default=[],
+                           help='comma-separated list of the symbols to export (default: all)')
+export_parser.add_argument('output', type=str,
+                           help='the output file ("-" for stdout) or directory')
+
+# "worker" command.
+worker_parser = subparsers.add_parser('worker',
+        help='pull the symbols of a job in the work queue')
+worker_parser.add_argument('-j', '--jobs', type=int, default=1,
+                           help='number of symbols to fetch in parallel')
+worker_parser.add_argument('--lease', type=str, default='10m',
+                           help='time after which symbols claimed by a dead worker are '
+                                'handed out again (default: 10m)')
+worker_parser.add_argument('--max-attempts', type=int, default=3,
+                           help='number of attempts before a symbol is marked as failed')
+worker_parser.add_argument('--retry-failed', action='store_true',
+                           help='try the symbols that failed before again')
+worker_parser.add_argument('job', type=str,
+                           help='the name of the job')
+
+# "status" command.
+status_parser = subparsers.add_parser('status',
+        help='show the progress of the jobs in the work queue')
+status_parser.add_argument('--failures', action='store_true',
+                           help='list the symbols that failed at least once')
+status_parser.add_argument('jobs', type=str, nargs='*',
+                           help='the names of the jobs (default: all)')
+
+# "backtest" command.
+backtest_parser = subparsers.add_parser('backtest',
+        help='run the Graham screen against the snapshot history on many dates')
+backtest_parser.add_argument('--filename', type=str, nargs='*', default = [],
+                             help='file containing a list of stock symbols')
+backtest_parser.add_argument('--start', type=str, default=None, metavar='DATE',
+                             help='first date (YYYY-MM-DD, default: first snapshot)')
+backtest_parser.add_argument('--end', type=str, default=None, metavar='DATE',
+                             help='last date (YYYY-MM-DD, default: last snapshot)')
+backtest_parser.add_argument('--every', type=str, default='30d',
+                             help='interval between the dates, e.g. 1w (default: 30d)')
+backtest_parser.add_argument('symbols', type=str, nargs='*',
+                             help='one or more stock symbols (default: all)')
+
+# "refresh" command.
+refresh_parser = subparsers.add_parser('refresh',
+        help='fetch the expired pages of the most important symbols first, '
+             'within a time or request budget')
+refresh_parser.add_argument('--budget', type=str, default=None, metavar='DURATION',
+                            help='stop starting new symbols after this time, e.g. 2h')
+refresh_parser.add_argument('--max-requests', type=int, default=None, metavar='N',
+                            help='stop before making more than N requests (one per page)')
+refresh_parser.add_argument('--ttl', type=str, action='append', default=[],
+                            metavar='PAGE=DURATION',
+                            help='maximum age of a page before it is fetched again, '
+                                 'e.g. key-stats=12h. Pages: ' + ', '.join(page_names))
+refresh_parser.add_argument('--source', type=str, default=None,
+                            choices=sorted(directories),
+                            help='also refresh the symbols of this list; symbols that were '
+                                 'newly listed since its previous download come first')
+refresh_parser.add_argument('--max-age', type=str, default=None,
+                            help='use the cached symbol list if it is younger than this, e.g. 12h')
+refresh_parser.add_argument('--filename', type=str, nargs='*', default = [],
+                            help='file containing a list of stock symbols')
+refresh_parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='number of symbols to fetch in parallel')
+refresh_parser.add_argument('--skipped', type=str, default=None, metavar='FILE',
+                            help='write the symbols that did not fit into the budget to FILE')
+refresh_parser.add_argument('--dry-run', action='store_true',
+                            help='only print the symbols in the order they would be fetched')
+add_filter_arguments(refresh_parser)
+refresh_parser.add_argument('symbols', type=str, nargs='*',
+                            help='stock symbols to refresh in addition to the stored ones')
+
 args = sys.argv[1:]
 args = parser.parse_args(args)
+parse_workers = args.parse_workers
+if args.stats:
+    atexit.register(write_stats, args.stats)
+if args.profile:
+    start_profiler(args.profile)
 
 if args.action == 'dir':
-    if args.source == 'nasdaq-traded':
-        stock_list = get_nasdaq_traded_stocks()
-    elif args.source == 'nasdaq-listed':
-        stock_list = get_nasdaq_listed_stocks()
-    else:
+    if args.source not in directories:
         parser.error('unknown source: ' + repr(args.source))
+    try:
+        max_age = parse_duration(args.max_age) if args.max_age else None
+    except ValueError as e:
+        parser.error(e)
+    from collect.nasdaq import get_nasdaq_changes
+    symbol_filter = get_symbol_filter(args)
+    stock_list = iter_directory(args.source, max_age, symbol_filter)
+    if not args.new and not args.delisted:
+        for l in stock_list:
+            print(l)
+        sys.exit(0)
+
     for l in stock_list:
+        pass
+    filename, column = directories[args.source]
+    added, removed = get_nasdaq_changes(filename, column, get_data_dir('nasdaq'))
+    added = filter_symbols(added, symbol_filter)
+    for l in (added if args.new else []) + (removed if args.delisted else []):
         print(l)
     sys.exit(0)
 
 elif args.action == 'pull':
-    symbols = args.symbols
-    for filename in args.filename:
-        try:
-            symbols += get_stocks_from_file(filename)
-        except OSError as e:
-            parser.error(e)
-    for symbol in symbols:
-        if args.force:
-            print(" Fetching fundamental data for " + symbol)
-            pull(symbol)
-        else:
-            print(" Fundamental data for {} is cached".format(symbol))
-            load(symbol)
+    from collect.fetch import progress
+    setup_http(args)
+    symbols = read_symbols(args)
+    try:
+        ttl = parse_ttl(args.ttl)
+    except ValueError as e:
+        parser.error(e)
+    pages = page_names + optional_page_names if args.stockrow else page_names
+    if args.shard and not args.job:
+        parser.error('--shard requires --job')
+    if args.job:
+        options = {'pages': pages, 'force': args.force, 'ttl': ttl}
+        if args.shard:
+            from store.queue import parse_shard, in_shard
+            try:
+                shard, shards = parse_shard(args.shard)
+            except ValueError as e:
+                parser.error(e)
+            symbols = [s for s in symbols if in_shard(s, shard, shards)]
+            options['shard'] = args.shard
+        queue = get_queue(args)
+        previous = queue.get_options(args.job)
+        if previous is not None and previous.get('shard') != options.get('shard'):
+            parser.error('job {!r} was created for shard {}'.format(
+                args.job, previous.get('shard') or 'none'))
+        queue.put(args.job, symbols, options)
+        for n, (symbol, error) in enumerate(run_worker(queue, args.job, args.jobs), 1):
+            progress(n, None, symbol, error)
+        sys.exit(0)
+    results = fetch_all(symbols, args.force, args.jobs, ttl, pages)
+    for n, (symbol, company, error) in enumerate(results, 1):
+        progress(n, len(symbols), symbol, error)
+    sys.exit(0)
+
+elif args.action == 'export':
+    from store.export import export_fields, export_csv, export_npy
+    names = export_fields
+    if args.fields:
+        names = [name.strip() for name in args.fields.split(',')]
+        unknown = [name for name in names if name not in export_fields]
+        if unknown:
+            parser.error('unknown fields: {}. Fields: {}'.format(
+                ', '.join(unknown), ', '.join(export_fields)))
+    symbols = read_symbols_or_all(args)
+    chunks = get_store().iter_companies()
+    if args.format == 'npy':
+        n = export_npy(chunks, args.output, names, symbols)
+    elif args.output == '-':
+        n = export_csv(chunks, sys.stdout, names, symbols)
+    else:
+        with open(args.output, 'w', newline='', buffering=1024*1024) as fp:
+            n = export_csv(chunks, fp, names, symbols)
+    sys.stderr.write('{} companies exported\n'.format(n))
+    sys.exit(0)
+
+elif args.action == 'worker':
+    from collect.fetch import progress
+    try:
+        lease = parse_duration(args.lease)
+    except ValueError as e:
+        parser.error(e)
+    setup_http(args)
+    queue = get_queue(args)
+    if queue.get_options(args.job) is None:
+        parser.error('unknown job: ' + repr(args.job))
+    if args.retry_failed:
+        queue.retry_failed(args.job)
+    results = run_worker(queue, args.job, args.jobs, lease, args.max_attempts)
+    for n, (symbol, error) in enumerate(results, 1):
+        progress(n, None, symbol, error)
+    sys.exit(0)
+
+elif args.action == 'status':
+    queue = get_queue(args)
+    for job in args.jobs or queue.jobs():
+        if queue.get_options(job) is None:
+            parser.error('unknown job: ' + repr(job))
+        status = queue.status(job)
+        print('{}: {done} of {total} done, {pending} pending, {claimed} claimed, '
+              '{failed} failed, {retries} retries'.format(job, **status))
+        if not args.failures:
+            continue
+        for symbol, attempts, error in queue.failures(job):
+            print('  {}: {} attempts, last error: {}'.format(symbol, attempts, error))
     sys.exit(0)
 
 elif args.action == 'graham':
     dump_successful = True if args.verbose >= 1 else False
     dump_failed = True if args.verbose >= 2 else False
-
-    symbols = args.symbols
-    for filename in args.filename:
+    from collect.fetch import progress
+    if args.as_of:
+        from store.history import parse_day
+        from analytics.screen import screen_columns, render_screen
         try:
-            symbols += get_stocks_from_file(filename)
-        except OSError as e:
+            day = parse_day(args.as_of)
+        except ValueError as e:
             parser.error(e)
+        symbols = read_symbols_or_all(args)
+        snapshot = get_history().as_of(day, symbols)
+        render_screen(screen_columns(*snapshot),
+                      dump_successful=dump_successful,
+                      dump_failed=dump_failed)
+        sys.exit(0)
 
-    for symbol in symbols:
-        if args.force:
-            company = pull(symbol)
-        else:
-            company = load(symbol)
+    if args.incremental or args.changes:
+        from analytics.screen import incremental_screen, screen_changes, render_screen
+        symbols = read_symbols_or_all(args)
+        result, previous = incremental_screen(get_store(), symbols)
+        if not args.changes:
+            render_screen(result,
+                          dump_successful=dump_successful,
+                          dump_failed=dump_failed)
+            sys.exit(0)
+        passing, failing, unchanged = screen_changes(result, previous)
+        for symbol in passing:
+            print('{}: newly passing'.format(symbol))
+        for symbol in failing:
+            print('{}: newly failing'.format(symbol))
+        print('{} unchanged'.format(len(unchanged)))
+        sys.exit(0)
+
+    from analytics.graham import graham_filter
+    setup_http(args)
+    symbols = read_symbols(args)
+
+    if args.staged:
+        from collect.fetch import map_ordered
+        from collect.fmp import FmpBatch
+        fmp_batch = FmpBatch(symbols) if len(symbols) > 1 else None
+        fetch = lambda s: fetch_staged(s, args.force, fmp_batch=fmp_batch)
+        results = map_ordered(fetch, symbols, args.jobs)
+        for n, (symbol, result, error) in enumerate(results, 1):
+            progress(n, len(symbols), symbol, error)
+            if error is not None:
+                continue
+            company, failed = result
+            if failed:
+                if dump_failed:
+                    print_early_rejection(symbol, failed)
+                continue
+            graham_filter(company,
+                          dump_successful=dump_successful,
+                          dump_failed=dump_failed)
+        sys.exit(0)
+
+    results = fetch_all(symbols, args.force, args.jobs)
+    if args.batch:
+        from analytics.screen import graham_screen, render_screen
+        from store.company import Company
+        companies = []
+        for n, (symbol, company, error) in enumerate(results, 1):
+            if error is not None:
+                progress(n, len(symbols), symbol, error)
+                continue
+            companies.append(Company.from_dict(company))
+        render_screen(graham_screen(companies),
+                      dump_successful=dump_successful,
+                      dump_failed=dump_failed)
+        sys.exit(0)
+
+    for n, (symbol, company, error) in enumerate(results, 1):
+        progress(n, len(symbols), symbol, error)
+        if error is not None:
+            continue
         graham_filter(company,
                       dump_successful=dump_successful,
                       dump_failed=dump_failed)
     sys.exit(0)
 
+elif args.action == 'screen':
+    dump_successful = True if args.verbose >= 1 else False
+    dump_failed = True if args.verbose >= 2 else False
+    try:
+        max_age = parse_duration(args.max_age) if args.max_age else None
+    except ValueError as e:
+        parser.error(e)
+
+    from collect.fetch import map_unordered, progress
+    from analytics.graham import graham_filter
+    setup_http(args)
+    symbols = iter_directory(args.source, max_age, get_symbol_filter(args))
+    if args.staged:
+        fetch = lambda s: fetch_staged(s, args.force)
+    else:
+        parallel = args.jobs > 1
+        load_or_pull = pull if args.force else load
+        fetch = lambda s: (load_or_pull(s, parallel), [])
+    results = map_unordered(fetch, symbols, args.jobs)
+    for n, (symbol, result, error) in enumerate(results, 1):
+        progress(n, None, symbol, error)
+        if error is not None:
+            continue
+        company, failed = result
+        if failed:
+            if dump_failed:
+                print_early_rejection(symbol, failed)
+            continue
+        graham_filter(company,
+                      dump_successful=dump_successful,
+                      dump_failed=dump_failed)
+    sys.exit(0)
+
+elif args.action == 'backtest':
+    from store.history import parse_day, format_day
+    from analytics.screen import screen_columns
+    history = get_history()
+    span = history.days()
+    if span is None:
+        parser.error('the snapshot history is empty, run "pull" first')
+    try:
+        start = parse_day(args.start) if args.start else span[0]
+        end = parse_day(args.end) if args.end else span[1]
+        every = max(1, int(parse_duration(args.every) // 86400))
+    except ValueError as e:
+        parser.error(e)
+    symbols = read_symbols_or_all(args)
+    for day in range(start, end+1, every):
+        result = screen_columns(*history.as_of(day, symbols))
+        passed = [row['symbol'] for row in result if row['passed']]
+        print('{}: {} of {} passed: {}'.format(format_day(day),
+                                               len(passed),
+                                               len(result),
+                                               ', '.join(passed)))
+    sys.exit(0)
+
+elif args.action == 'refresh':
+    try:
+        ttl = parse_ttl(args.ttl)
+        budget = parse_duration(args.budget) if args.budget else None
+        max_age = parse_duration(args.max_age) if args.max_age else None
+    except ValueError as e:
+        parser.error(e)
+    from collect.fetch import progress
+    from analytics.schedule import rank_symbols
+    store = get_store()
+    symbol_filter = get_symbol_filter(args)
+    symbols = filter_symbols(store.symbols(), symbol_filter) + read_symbols(args)
+    new = []
+    if args.source:
+        from collect.nasdaq import get_nasdaq_changes
+        symbols += iter_directory(args.source, max_age, symbol_filter)
+        filename, column = directories[args.source]
+        new, removed = get_nasdaq_changes(filename, column, get_data_dir('nasdaq'))
+    excluded = set(read_symbol_files(args.exclude))
+    symbols = [s for s in dict.fromkeys(symbols) if s not in excluded]
+    companies = store.load_companies()
+    ranked = rank_symbols(symbols, companies, store.load_freshness(), ttl, new)
+    if args.dry_run:
+        for symbol, score, pages in ranked:
+            print('{} {:.2f} {}'.format(symbol, score, ','.join(pages)))
+        sys.exit(0)
+
+    setup_http(args)
+    skipped = []
+    results = refresh(ranked, args.jobs, budget, args.max_requests, skipped)
+    fetched = 0
+    for n, (symbol, company, error) in enumerate(results, 1):
+        progress(n, len(ranked), symbol, error)
+        fetched += 1
+    skipped_symbols = [symbol for symbol, score, pages in skipped]
+    store.set_meta('refresh-skipped', json.dumps({'time': time.time(),
+                                                  'symbols': skipped_symbols}))
+    if args.skipped:
+        with open(args.skipped, 'w') as fp:
+            fp.writelines(symbol + '\n' for symbol in skipped_symbols)
+    sys.stderr.write('{} of {} symbols refreshed, {} skipped\n'.format(
+        fetched, len(ranked), len(skipped_symbols)))
+    sys.exit(0)
+
 else:
     parser.error('unknown action: ' + repr(args.action))
@@ -0,0 +1,498 @@
+import os
+import glob
+import json
+import math
+import hashlib
+import sqlite3
+import time
+import datetime
+import threading
+from array import array
+from functools import lru_cache
+from itertools import groupby
+from collect.stats import stats
+
+# Maps the keys of a company dict to the columns of the companies table.
+fields = (('rating', 'rating'),
+          ('share-price', 'share_price'),
+          ('total-debt', 'total_debt'),
+          ('total-debt-equity', 'total_debt_equity'),
+          ('pe-trailing', 'pe_trailing'),
+          ('pe-forward', 'pe_forward'),
+          ('p-bv', 'p_bv'),
+          ('dividend-forward', 'dividend_forward'),
+          ('current-ratio', 'current_ratio'),
+          ('latest-net-income', 'latest_net_income'),
+          ('total-revenue', 'total_revenue'),
+          ('gross-profit', 'gross_profit'),
+          ('total-assets', 'total_assets'))
+columns = [column for key, column in fields]
+field_index = dict((key, n) for n, (key, column) in enumerate(fields))
+
+schema = '''
+CREATE TABLE IF NOT EXISTS companies (
+    symbol TEXT PRIMARY KEY,
+    {}
+);
+CREATE TABLE IF NOT EXISTS net_income (
+    symbol TEXT NOT NULL,
+    date TEXT NOT NULL,
+    value NUMERIC,
+    PRIMARY KEY (symbol, date)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS balance_sheet_history (
+    symbol TEXT NOT NULL,
+    date TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value NUMERIC,
+    PRIMARY KEY (symbol, date, field)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS freshness (
+    symbol TEXT NOT NULL,
+    page TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (symbol, page)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS fingerprints (
+    symbol TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS screen_results (
+    symbol TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    result TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''.format(',\n    '.join(c + ' NUMERIC' for c in columns))
+
+@lru_cache(maxsize=4096)
+def date_to_ordinal(value):
+    """
+    Converts a date like "2018-09-29" (or "2018-09") to its ordinal.
+    Companies share few distinct dates, so the results are cached.
+    """
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').toordinal()
+    except ValueError:
+        return datetime.datetime.strptime(value, '%Y-%m').toordinal()
+
+def _to_float(value):
+    if value is None:
+        return math.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+class Company(object):
+    """
+    A compact record of the data of one company. The numeric fields
+    (see fields) are stored in a single float array, with NaN for
+    missing values, and are available as attributes named like the
+    columns, e.g. company.pe_forward. The net income series is stored
+    as two arrays, ni_days (date ordinals) and ni_values, in ascending
+    date order.
+
+    A Company can also be used like the dicts returned by
+    fetch_symbol_data(), so it can be passed to graham_filter() and
+    CompanyStore.save(): company['pe-forward'] returns the value, or
+    None if it is missing.
+    """
+    __slots__ = ('symbol', 'values', 'ni_days', 'ni_values', 'balance_sheet_history')
+
+    def __init__(self, symbol, values=None, ni_days=None, ni_values=None,
+                 balance_sheet_history=None):
+        self.symbol = symbol
+        if values is None:
+            values = array('d', [math.nan]) * len(fields)
+        self.values = values
+        self.ni_days = ni_days if ni_days is not None else array('i')
+        self.ni_values = ni_values if ni_values is not None else array('d')
+        self.balance_sheet_history = balance_sheet_history
+
+    @classmethod
+    def from_dict(cls, company):
+        """
+        Creates a Company from a dict as returned by fetch_symbol_data().
+        """
+        record = cls(company['symbol'],
+                     array('d', [_to_float(company.get(key)) for key, column in fields]),
+                     balance_sheet_history=company.get('balance-sheet-history'))
+        record.set_net_income(company.get('net-income'))
+        return record
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Creates a Company from a row of the companies table, i.e. the
+        symbol followed by the value of each of the columns.
+        """
+        return cls(row[0], array('d', [math.nan if v is None else v for v in row[1:]]))
+
+    def set_net_income(self, series):
+        """
+        Replaces the net income series by the given dict (or list of
+        tuples) mapping the date to the value. Missing values are
+        skipped.
+        """
+        if isinstance(series, dict):
+            series = series.items()
+        series = sorted((date_to_ordinal(date), float(value))
+                        for date, value in (series or ()) if value is not None)
+        self.ni_days = array('i', [day for day, value in series])
+        self.ni_values = array('d', [value for day, value in series])
+
+    def get_net_income(self):
+        """
+        Returns the net income series as a dict mapping the date to the
+        value, most recent first, or None if there is no series.
+        """
+        if not self.ni_days:
+            return None
+        return dict((datetime.date.fromordinal(day).isoformat(), value)
+                    for day, value in zip(reversed(self.ni_days), reversed(self.ni_values)))
+
+    def to_dict(self):
+        return dict((key, self[key]) for key in self.keys())
+
+    def keys(self):
+        return ['symbol'] + [key for key, column in fields] + \
+               ['net-income', 'balance-sheet-history']
+
+    def __getitem__(self, key):
+        index = field_index.get(key)
+        if index is not None:
+            value = self.values[index]
+            if math.isnan(value):
+                return None
+            return int(value) if value.is_integer() else value
+        if key == 'symbol':
+            return self.symbol
+        if key == 'net-income':
+            return self.get_net_income()
+        if key == 'balance-sheet-history':
+            return self.balance_sheet_history
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        index = field_index.get(key)
+        if index is not None:
+            self.values[index] = _to_float(value)
+        elif key == 'symbol':
+            self.symbol = value
+        elif key == 'net-income':
+            self.set_net_income(value)
+        elif key == 'balance-sheet-history':
+            self.balance_sheet_history = value
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in field_index or key in ('symbol', 'net-income', 'balance-sheet-history')
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def __repr__(self):
+        return 'Company({!r})'.format(self.symbol)
+
+for _index, (_key, _column) in enumerate(fields):
+    setattr(Company, _column, property(lambda self, n=_index: self.values[n]))
+
+def fingerprint(company):
+    """
+    Returns a hash of the fields and the net income series of the given
+    company, which changes whenever the stored data changes.
+    """
+    values = [company.get(key) for key, column in fields]
+    series = sorted((company.get('net-income') or {}).items())
+    data = json.dumps([values, series], default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+class CompanyStore(object):
+    """
+    Stores the fundamental data of all companies in a single SQLite
+    file. Companies are passed in and returned as the dicts produced
+    by fetch_symbol_data().
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(schema)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _save(self, company, pages=(), fetched=None):
+        symbol = company['symbol']
+        values = [symbol] + [company.get(key) for key, column in fields]
+        self.db.execute('INSERT OR REPLACE INTO companies (symbol, {}) VALUES ({})'.format(
+            ', '.join(columns), ', '.join('?' * len(values))), values)
+        self.db.execute('DELETE FROM net_income WHERE symbol=?', (symbol,))
+        series = company.get('net-income') or {}
+        self.db.executemany('INSERT INTO net_income VALUES (?, ?, ?)',
+                            [(symbol, d, v) for (d, v) in series.items()])
+        # The history is only fetched on request, so keep what we have.
+        history = company.get('balance-sheet-history')
+        if history is not None:
+            self.db.execute('DELETE FROM balance_sheet_history WHERE symbol=?', (symbol,))
+            self.db.executemany('INSERT INTO balance_sheet_history VALUES (?, ?, ?, ?)',
+                                [(symbol, d, f, v)
+                                 for (d, entry) in history.items()
+                                 for (f, v) in entry.items()])
+        self.db.execute('INSERT OR REPLACE INTO fingerprints VALUES (?, ?)',
+                        (symbol, fingerprint(company)))
+        if fetched is None:
+            fetched = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO freshness VALUES (?, ?, ?)',
+                            [(symbol, page, fetched) for page in pages])
+
+    def save(self, company, pages=(), fetched=None):
+        """
+        Inserts or replaces the given company. pages is a list of the
+        names of the source pages that were fetched; they are marked
+        as fetched at the given time (default: now).
+        """
+        with stats.timer('disk', 'store-save'), self.lock, self.db:
+            self._save(company, pages, fetched)
+
+    def save_many(self, companies, pages=(), fetched=None):
+        """
+        Like save(), but stores all companies in one transaction.
+        """
+        with self.lock, self.db:
+            for company in companies:
+                self._save(company, pages, fetched)
+
+    def _load(self, where='', params=()):
+        with stats.timer('disk', 'store-load'), self.lock:
+            rows = self.db.execute('SELECT symbol, {} FROM companies {}'.format(
+                ', '.join(columns), where), params).fetchall()
+            series = self.db.execute(
+                'SELECT symbol, date, value FROM net_income {} ORDER BY symbol, date DESC'.format(where),
+                params).fetchall()
+            history = self.db.execute(
+                'SELECT symbol, date, field, value FROM balance_sheet_history {} ORDER BY symbol, date DESC'.format(where),
+                params).fetchall()
+        companies = {}
+        for row in rows:
+            company = {'symbol': row[0]}
+            for (key, column), value in zip(fields, row[1:]):
+                company[key] = value
+            company['net-income'] = None
+            company['balance-sheet-history'] = None
+            companies[row[0]] = company
+        for symbol, date, value in series:
+            company = companies.get(symbol)
+            if company is None:
+                continue
+            if company['net-income'] is None:
+                company['net-income'] = {}
+            company['net-income'][date] = value
+        for symbol, date, field, value in history:
+            company = companies.get(symbol)
+            if company is None:
+                continue
+            if company['balance-sheet-history'] is None:
+                company['balance-sheet-history'] = {}
+            company['balance-sheet-history'].setdefault(date, {})[field] = value
+        return companies
+
+    def _load_companies(self, where='', params=()):
+        with stats.timer('disk', 'store-load'), self.lock:
+            rows = self.db.execute('SELECT symbol, {} FROM companies {}'.format(
+                ', '.join(columns), where), params).fetchall()
+            series = self.db.execute(
+                'SELECT symbol, date, value FROM net_income {} ORDER BY symbol, date'.format(where),
+                params).fetchall()
+        companies = dict((row[0], Company.from_row(row)) for row in rows)
+        for symbol, group in groupby(series, lambda row: row[0]):
+            company = companies.get(symbol)
+            if company is None:
+                continue
+            group = [row for row in group if row[2] is not None]
+            company.ni_days = array('i', [date_to_ordinal(row[1]) for row in group])
+            company.ni_values = array('d', [row[2] for row in group])
+        return companies
+
+    def load_companies(self, symbols=None):
+        """
+        Like load_many() (or load_all(), if symbols is None), but
+        returns Company records. The balance sheet history is not
+        loaded; it is left untouched if such a record is saved.
+        """
+        if symbols is None:
+            return self._load_companies()
+        symbols = list(symbols)
+        if len(symbols) > 500:
+            companies = self._load_companies()
+            return dict((s, companies[s]) for s in symbols if s in companies)
+        where = 'WHERE symbol IN ({})'.format(', '.join('?' * len(symbols)))
+        return self._load_companies(where, symbols)
+
+    def iter_companies(self, chunk_size=10000):
+        """
+        Yields all companies as lists of up to chunk_size Company
+        records, ordered by symbol, so that the whole store can be
+        processed without loading it at once.
+        """
+        last = ''
+        while True:
+            with self.lock:
+                symbols = [row[0] for row in self.db.execute(
+                    'SELECT symbol FROM companies WHERE symbol > ? ORDER BY symbol LIMIT ?',
+                    (last, chunk_size))]
+            if not symbols:
+                return
+            companies = self._load_companies('WHERE symbol BETWEEN ? AND ?',
+                                             (symbols[0], symbols[-1]))
+            yield [companies[s] for s in symbols if s in companies]
+            last = symbols[-1]
+
+    def load(self, symbol):
+        """
+        Returns the company with the given symbol, or None.
+        """
+        return self._load('WHERE symbol=?', (symbol,)).get(symbol)
+
+    def load_many(self, symbols):
+        """
+        Returns a dict mapping each of the given symbols to a company.
+        Symbols that are not in the store are omitted.
+        """
+        symbols = list(symbols)
+        if len(symbols) > 500:
+            companies = self.load_all()
+            return dict((s, companies[s]) for s in symbols if s in companies)
+        where = 'WHERE symbol IN ({})'.format(', '.join('?' * len(symbols)))
+        return self._load(where, symbols)
+
+    def load_freshness(self, symbols=None):
+        """
+        Returns a dict mapping each symbol to a dict that maps the
+        page name to the time when it was last fetched.
+        """
+        query = 'SELECT symbol, page, fetched FROM freshness'
+        params = ()
+        if symbols is not None:
+            symbols = set(symbols)
+            if len(symbols) <= 500:
+                params = list(symbols)
+                query += ' WHERE symbol IN ({})'.format(', '.join('?' * len(params)))
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        freshness = {}
+        for symbol, page, fetched in rows:
+            if symbols is None or symbol in symbols:
+                freshness.setdefault(symbol, {})[page] = fetched
+        return freshness
+
+    def load_all(self):
+        """
+        Returns a dict mapping the symbol to the company, for all
+        companies in the store.
+        """
+        return self._load()
+
+    def symbols(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT symbol FROM companies')]
+
+    def load_changed(self, symbols=None):
+        """
+        Returns the companies whose data changed since their screen
+        result was saved (or that were never screened), as a dict that
+        maps the symbol to a tuple (company, fingerprint).
+        If symbols is given, only these companies are considered.
+        """
+        with self.lock:
+            rows = self.db.execute('''
+                SELECT c.symbol, f.fingerprint FROM companies c
+                LEFT JOIN fingerprints f ON f.symbol=c.symbol
+                LEFT JOIN screen_results r ON r.symbol=c.symbol
+                WHERE f.fingerprint IS NULL OR r.fingerprint IS NOT f.fingerprint''').fetchall()
+        if symbols is not None:
+            symbols = set(symbols)
+            rows = [row for row in rows if row[0] in symbols]
+        if not rows:
+            return {}
+        companies = self.load_companies([symbol for symbol, fp in rows])
+
+        # Companies that were stored by older versions have no fingerprint yet.
+        missing = [(symbol, fingerprint(companies[symbol]))
+                   for symbol, fp in rows if fp is None and symbol in companies]
+        if missing:
+            with self.lock, self.db:
+                self.db.executemany('INSERT OR REPLACE INTO fingerprints VALUES (?, ?)', missing)
+        fingerprints = dict(rows)
+        fingerprints.update(missing)
+        return dict((symbol, (company, fingerprints[symbol]))
+                    for symbol, company in companies.items())
+
+    def load_screen_results(self, symbols=None):
+        """
+        Returns a dict mapping each symbol to the screen result that was
+        saved with save_screen_results().
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT symbol, result FROM screen_results').fetchall()
+        if symbols is not None:
+            symbols = set(symbols)
+        return dict((symbol, json.loads(result)) for symbol, result in rows
+                    if symbols is None or symbol in symbols)
+
+    def save_screen_results(self, results):
+        """
+        Stores screen results, given as (symbol, fingerprint, result)
+        tuples where result is a JSON serializable dict. fingerprint
+        is the one returned by load_changed() for the screened data.
+        """
+        with stats.timer('disk', 'store-save'), self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO screen_results VALUES (?, ?, ?)',
+                                [(symbol, fp, json.dumps(result))
+                                 for symbol, fp, result in results])
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def migrate_json_dir(self, dirname):
+        """
+        Imports all data/<SYMBOL>.json files that were written by
+        earlier versions. This happens only once per store; the JSON
+        files are left untouched. Their values were computed with the
+        old (wrong) unit factors, so no page is marked as fetched, and
+        every page of these companies is fetched again by the next run.
+        Returns the number of imported files.
+        """
+        if self.get_meta('json-migrated'):
+            return 0
+        filenames = glob.glob(os.path.join(dirname, '*.json'))
+        n = 0
+        with self.lock, self.db:
+            for filename in filenames:
+                with open(filename) as fp:
+                    try:
+                        company = json.load(fp)
+                    except ValueError:
+                        continue
+                self._save(company)
+                n += 1
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('json-migrated', '1')")
+        return n
@@ -0,0 +1,114 @@
+import os
+import csv
+import glob
+import math
+import shutil
+import numpy as np
+from .company import fields, field_index
+
+# The number of net income values that are exported per company.
+net_income_years = 4
+
+# All fields that can be exported, besides the symbol. net-income-1 is
+# the most recent annual net income, net-income-2 the one before, etc.
+export_fields = [key for key, column in fields] + \
+                ['net-income-{}'.format(n+1) for n in range(net_income_years)]
+
+def _get_matrix(chunk, names):
+    """
+    Returns the given fields of a list of Company records as a
+    (companies, fields) float array.
+    """
+    values = np.frombuffer(b''.join([c.values.tobytes() for c in chunk]))
+    values = values.reshape(len(chunk), len(fields))
+    matrix = np.full((len(chunk), len(names)), np.nan)
+    for n, name in enumerate(names):
+        index = field_index.get(name)
+        if index is not None:
+            matrix[:, n] = values[:, index]
+            continue
+        year = int(name.rsplit('-', 1)[1])
+        for i, company in enumerate(chunk):
+            if year <= len(company.ni_values):
+                matrix[i, n] = company.ni_values[-year]
+    return matrix
+
+def _filter(chunks, symbols):
+    if symbols is None:
+        return chunks
+    symbols = set(symbols)
+    return ([c for c in chunk if c.symbol in symbols] for chunk in chunks)
+
+def export_csv(chunks, fp, names=export_fields, symbols=None):
+    """
+    Writes the companies from the given chunks (lists of Company
+    records, see CompanyStore.iter_companies()) to the given file
+    object as CSV, one row per company. Missing values are empty.
+    If symbols is given, only these companies are written.
+    Returns the number of written rows.
+    """
+    writer = csv.writer(fp)
+    writer.writerow(['symbol'] + list(names))
+    n = 0
+    for chunk in _filter(chunks, symbols):
+        if not chunk:
+            continue
+        matrix = _get_matrix(chunk, names).tolist()
+        writer.writerows([company.symbol] + ['' if math.isnan(v) else repr(v) for v in row]
+                         for company, row in zip(chunk, matrix))
+        n += len(chunk)
+    return n
+
+def export_npy(chunks, dirname, names=export_fields, symbols=None):
+    """
+    Like export_csv(), but writes one .npy file per field into the
+    given directory: symbol.npy and e.g. pe-forward.npy (float64, NaN
+    for missing values). Use load_npy() to memory-map them.
+    Returns the number of written rows.
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    # The number of rows is not known up front, so the columns are
+    # streamed to raw files first and prefixed with a header at the end.
+    raw_files = dict((name, open(os.path.join(dirname, name + '.raw'), 'wb'))
+                     for name in names)
+    all_symbols = []
+    try:
+        for chunk in _filter(chunks, symbols):
+            if not chunk:
+                continue
+            all_symbols += [company.symbol for company in chunk]
+            matrix = _get_matrix(chunk, names)
+            for n, name in enumerate(names):
+                raw_files[name].write(matrix[:, n].tobytes())
+    finally:
+        for fp in raw_files.values():
+            fp.close()
+
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float64)),
+              'fortran_order': False,
+              'shape': (len(all_symbols),)}
+    for name in names:
+        raw_filename = os.path.join(dirname, name + '.raw')
+        with open(os.path.join(dirname, name + '.npy'), 'wb') as fp:
+            np.lib.format.write_array_header_1_0(fp, header)
+            with open(raw_filename, 'rb') as raw:
+                shutil.copyfileobj(raw, fp, 1024*1024)
+        os.remove(raw_filename)
+    np.save(os.path.join(dirname, 'symbol.npy'), np.array(all_symbols, dtype=str))
+    return len(all_symbols)
+
+def load_npy(dirname, mmap=True):
+    """
+    Returns a dict mapping each field that was exported by export_npy()
+    into the given directory to its array. With mmap, the arrays are
+    memory-mapped instead of read. Pass the result to
+    pandas.DataFrame() to get a table.
+    """
+    mode = 'r' if mmap else None
+    columns = {'symbol': np.load(os.path.join(dirname, 'symbol.npy'))}
+    for filename in sorted(glob.glob(os.path.join(dirname, '*.npy'))):
+        name = os.path.basename(filename)[:-4]
+        if name != 'symbol':
+            columns[name] = np.load(filename, mmap_mode=mode)
+    return columns
@@ -0,0 +1,222 @@
+import os
+import fcntl
+import datetime
+import threading
+import contextlib
+import numpy as np
+from .company import fields
+
+# The number of most recent net income values kept per snapshot.
+net_income_years = 4
+
+net_income_columns = ['net-income-{}'.format(n) for n in range(net_income_years)]
+
+# Maps the name of each column file to its numpy type. Every file has
+# one entry per snapshot, so row n of all files form one snapshot.
+column_types = [('symbol', np.int32), ('day', np.int32)] + \
+               [(key, np.float64) for key, column in fields] + \
+               [(name, np.float64) for name in net_income_columns] + \
+               [('net-income-count', np.int8)]
+
+def parse_day(value):
+    """
+    Converts a date in ISO format (e.g. "2019-03-31") to the day
+    ordinal that is used by SnapshotHistory.
+    """
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date().toordinal()
+
+def format_day(day):
+    return datetime.date.fromordinal(int(day)).isoformat()
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+class SnapshotHistory(object):
+    """
+    An append-only history of company snapshots, stored in a directory
+    as one raw file per field (see column_types). The files are read as
+    memory-mapped arrays, so a screen over a past date only touches the
+    rows it needs instead of loading the whole history.
+    Snapshots are buffered in memory until flush() is called. Several
+    processes may append to the same history; flush() locks the
+    directory, so their rows and symbol indices do not get mixed up.
+    """
+    def __init__(self, dirname, buffer_size=1000):
+        self.dirname = dirname
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.buffer = []
+        os.makedirs(dirname, exist_ok=True)
+        self.symbols_file = os.path.join(dirname, 'symbols.txt')
+        self.lock_file = os.path.join(dirname, 'lock')
+        self.symbols = []
+        self.symbol_index = {}
+        with self._locked(fcntl.LOCK_EX):
+            self._load_symbols()
+            self._repair()
+        days = self._map('day')
+        self.last_day = int(days[-1]) if len(days) else 0
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        """
+        Holds a lock on the directory (fcntl.LOCK_EX or LOCK_SH), which
+        excludes other processes using the same history.
+        """
+        with open(self.lock_file, 'a') as fp:
+            fcntl.flock(fp, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _load_symbols(self):
+        """
+        Reads the symbols that other processes added since the last call.
+        """
+        if not os.path.isfile(self.symbols_file):
+            return
+        with open(self.symbols_file) as fp:
+            symbols = [line.strip() for line in fp if line.strip()]
+        for symbol in symbols[len(self.symbols):]:
+            self.symbol_index[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+
+    def _filename(self, name):
+        return os.path.join(self.dirname, name + '.bin')
+
+    def _repair(self):
+        """
+        Truncates all files to the same number of rows, in case an
+        earlier flush() was interrupted.
+        """
+        sizes = []
+        for name, dtype in column_types:
+            filename = self._filename(name)
+            size = os.path.getsize(filename) if os.path.isfile(filename) else 0
+            sizes.append(size // np.dtype(dtype).itemsize)
+        rows = min(sizes)
+        for name, dtype in column_types:
+            filename = self._filename(name)
+            size = rows * np.dtype(dtype).itemsize
+            if not os.path.isfile(filename):
+                open(filename, 'wb').close()
+            elif os.path.getsize(filename) != size:
+                os.truncate(filename, size)
+
+    def _map(self, name):
+        dtype = dict(column_types)[name]
+        filename = self._filename(name)
+        if os.path.getsize(filename) == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return len(self._map('day')) + len(self.buffer)
+
+    def append(self, company, day=None):
+        """
+        Adds a snapshot of the given company, taken on the given day
+        (an ordinal as returned by parse_day(); default: today).
+        Days never go backwards, so the history stays sorted by day.
+        """
+        if day is None:
+            day = datetime.date.today().toordinal()
+        symbol = company['symbol']
+        series = sorted((company.get('net-income') or {}).items())
+        series = [_to_float(value) for date, value in series][-net_income_years:]
+        with self.lock:
+            self.last_day = max(self.last_day, day)
+            row = [symbol, self.last_day]
+            row += [_to_float(company.get(key)) for key, column in fields]
+            row += series + [np.nan] * (net_income_years - len(series))
+            row.append(len(series))
+            self.buffer.append(row)
+            if len(self.buffer) >= self.buffer_size:
+                self._flush()
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        with self._locked(fcntl.LOCK_EX):
+            # Symbol indices and days are assigned under the lock, after
+            # reading what other processes appended in the meantime.
+            self._load_symbols()
+            self._repair()
+            new_symbols = []
+            for row in self.buffer:
+                if row[0] not in self.symbol_index:
+                    self.symbol_index[row[0]] = len(self.symbols)
+                    self.symbols.append(row[0])
+                    new_symbols.append(row[0])
+            if new_symbols:
+                with open(self.symbols_file, 'a') as fp:
+                    fp.write(''.join(s + '\n' for s in new_symbols))
+            days = self._map('day')
+            last_day = int(days[-1]) if len(days) else 0
+            for row in self.buffer:
+                row[0] = self.symbol_index[row[0]]
+                row[1] = max(row[1], last_day)
+            for n, (name, dtype) in enumerate(column_types):
+                values = np.array([row[n] for row in self.buffer], dtype=dtype)
+                with open(self._filename(name), 'ab') as fp:
+                    fp.write(values.tobytes())
+        self.buffer = []
+
+    def flush(self):
+        """
+        Writes all buffered snapshots to disk.
+        """
+        with self.lock:
+            self._flush()
+
+    def days(self):
+        """
+        Returns the day ordinals of the first and the last snapshot,
+        or None if the history is empty.
+        """
+        self.flush()
+        with self._locked(fcntl.LOCK_SH):
+            days = self._map('day')
+        if not len(days):
+            return None
+        return int(days[0]), int(days[-1])
+
+    def as_of(self, day, symbols=None):
+        """
+        Returns the latest snapshot of each company that was taken on
+        or before the given day, sorted by symbol, as a tuple (symbols,
+        columns, ni, ni_lengths) that can be passed to screen_columns().
+        If symbols is given, only these companies are included; those
+        without a snapshot are omitted.
+        """
+        self.flush()
+        with self._locked(fcntl.LOCK_SH):
+            self._load_symbols()
+            return self._as_of(day, symbols)
+
+    def _as_of(self, day, symbols):
+        end = int(np.searchsorted(self._map('day'), day, side='right'))
+        indices = np.asarray(self._map('symbol')[:end])
+        # The last row of each symbol in the prefix is its latest snapshot.
+        unique, first = np.unique(indices[::-1], return_index=True)
+        rows = end - 1 - first
+        if symbols is not None:
+            wanted = [self.symbol_index[s] for s in symbols if s in self.symbol_index]
+            keep = np.isin(unique, wanted)
+            unique, rows = unique[keep], rows[keep]
+        # Sorted by symbol, so that the output does not depend on the
+        # order in which the snapshots were written.
+        names = [self.symbols[i] for i in unique]
+        order = sorted(range(len(names)), key=names.__getitem__)
+        names = [names[n] for n in order]
+        rows = rows[order]
+        columns = dict((key, np.asarray(self._map(key)[rows]))
+                       for key, column in fields)
+        ni = np.column_stack([np.asarray(self._map(name)[rows])
+                              for name in net_income_columns])
+        lengths = self._map('net-income-count')[rows].astype(int)
+        return names, columns, ni, lengths
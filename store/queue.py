@@ -0,0 +1,203 @@
+import json
+import zlib
+import sqlite3
+import time
+import threading
+
+schema = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    job TEXT PRIMARY KEY,
+    options TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    job TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    error TEXT,
+    updated REAL,
+    PRIMARY KEY (job, symbol)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (job, state, position);
+'''
+
+# The states of a task. Claimed tasks whose lease expired are handed
+# out again, so a worker that dies does not lose its symbols.
+states = ('pending', 'claimed', 'done', 'failed')
+
+def parse_shard(value):
+    """
+    Parses a shard given as "K/N" (the K-th of N shards, counting from
+    1) and returns the tuple (K, N).
+    """
+    try:
+        shard, shards = [int(n) for n in value.split('/')]
+    except ValueError:
+        raise ValueError('invalid shard: {!r}, expected e.g. 1/4'.format(value))
+    if not 1 <= shard <= shards:
+        raise ValueError('invalid shard: {!r}, expected e.g. 1/4'.format(value))
+    return shard, shards
+
+def in_shard(symbol, shard, shards):
+    """
+    Returns True if the given symbol belongs to the given shard (see
+    parse_shard()). The partition only depends on the symbol, so every
+    host computes the same one from the same list.
+    """
+    return zlib.crc32(symbol.encode('utf-8')) % shards == shard - 1
+
+class WorkQueue(object):
+    """
+    A durable queue of symbols to pull, stored in a SQLite file that
+    can be shared by several worker processes on the same host (WAL
+    mode does not work on network filesystems). Symbols belong to a
+    named job; workers claim them for the duration of a lease, and
+    acknowledge each symbol once it is stored.
+    """
+    def __init__(self, filename, timeout=60):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename,
+                                  timeout=timeout,
+                                  isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(schema)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _transaction(self, func, *args):
+        # BEGIN IMMEDIATE takes the write lock up front, so that two
+        # processes can not claim the same task.
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(*args)
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+            return result
+
+    def put(self, job, symbols, options=None):
+        """
+        Adds the given symbols to the given job, which is created with
+        the given options (a JSON serializable dict) if it does not
+        exist. Symbols that are already part of the job are skipped,
+        so putting the same list again resumes the job.
+        Returns the number of added symbols.
+        """
+        def put():
+            self.db.execute('INSERT OR IGNORE INTO jobs VALUES (?, ?, ?)',
+                            (job, json.dumps(options or {}), time.time()))
+            start = self.db.execute('SELECT COUNT(*) FROM tasks WHERE job=?',
+                                    (job,)).fetchone()[0]
+            before = self.db.total_changes
+            self.db.executemany(
+                'INSERT OR IGNORE INTO tasks (job, symbol, position) VALUES (?, ?, ?)',
+                [(job, symbol, start+n) for n, symbol in enumerate(symbols)])
+            return self.db.total_changes - before
+        return self._transaction(put)
+
+    def get_options(self, job):
+        """
+        Returns the options of the given job, or None if there is no
+        such job.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT options FROM jobs WHERE job=?', (job,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def jobs(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT job FROM jobs ORDER BY created')]
+
+    def claim(self, job, worker, count=1, lease=600):
+        """
+        Claims up to count pending symbols of the given job for the
+        given worker, for lease seconds. Symbols whose lease expired
+        are claimed again. Returns the list of claimed symbols; an
+        empty list means that there is nothing left to do.
+        """
+        def claim():
+            now = time.time()
+            symbols = [row[0] for row in self.db.execute('''
+                SELECT symbol FROM tasks
+                WHERE job=? AND (state='pending' OR (state='claimed' AND lease_until<?))
+                ORDER BY position LIMIT ?''', (job, now, count))]
+            self.db.executemany('''
+                UPDATE tasks SET state='claimed', worker=?, lease_until=?,
+                                 attempts=attempts+1, updated=?
+                WHERE job=? AND symbol=?''',
+                [(worker, now+lease, now, job, symbol) for symbol in symbols])
+            return symbols
+        return self._transaction(claim)
+
+    def ack(self, job, symbol):
+        """
+        Marks the given symbol as done.
+        """
+        def ack():
+            self.db.execute('''
+                UPDATE tasks SET state='done', lease_until=NULL, error=NULL, updated=?
+                WHERE job=? AND symbol=?''', (time.time(), job, symbol))
+        self._transaction(ack)
+
+    def fail(self, job, symbol, error, max_attempts=3):
+        """
+        Records a failure of the given symbol. The symbol is pending
+        again unless it failed max_attempts times.
+        """
+        def fail():
+            self.db.execute('''
+                UPDATE tasks SET state=CASE WHEN attempts<? THEN 'pending' ELSE 'failed' END,
+                                 lease_until=NULL, error=?, updated=?
+                WHERE job=? AND symbol=?''',
+                (max_attempts, str(error), time.time(), job, symbol))
+        self._transaction(fail)
+
+    def retry_failed(self, job):
+        """
+        Makes all failed symbols of the given job pending again.
+        Returns their number.
+        """
+        def retry():
+            return self.db.execute('''
+                UPDATE tasks SET state='pending', attempts=0
+                WHERE job=? AND state='failed' ''', (job,)).rowcount
+        return self._transaction(retry)
+
+    def status(self, job):
+        """
+        Returns a dict containing the number of symbols in each state,
+        the total, and the number of retries, i.e. of attempts beyond
+        the first.
+        """
+        with self.lock:
+            rows = self.db.execute('''
+                SELECT state, COUNT(*), SUM(MAX(attempts-1, 0)) FROM tasks
+                WHERE job=? GROUP BY state''', (job,)).fetchall()
+        status = dict((state, 0) for state in states)
+        status['retries'] = 0
+        for state, count, retries in rows:
+            status[state] = count
+            status['retries'] += retries or 0
+        status['total'] = sum(status[state] for state in states)
+        return status
+
+    def failures(self, job):
+        """
+        Returns a list of (symbol, attempts, error) tuples for the
+        symbols of the given job that failed at least once.
+        """
+        with self.lock:
+            return self.db.execute('''
+                SELECT symbol, attempts, error FROM tasks
+                WHERE job=? AND error IS NOT NULL
+                ORDER BY position''', (job,)).fetchall()
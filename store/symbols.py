@@ -0,0 +1,138 @@
+import sqlite3
+import threading
+from collect.stats import stats
+
+schema = '''
+CREATE TABLE IF NOT EXISTS symbols (
+    source TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    name TEXT,
+    exchange TEXT,
+    market_category TEXT,
+    etf INTEGER NOT NULL,
+    test_issue INTEGER NOT NULL,
+    financial_status TEXT,
+    PRIMARY KEY (source, symbol)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS symbols_symbol ON symbols (symbol);
+'''
+
+# Maps the keys of the rows from collect.nasdaq.iter_nasdaq_rows()
+# to the columns of the index.
+fields = (('symbol', 'symbol'),
+          ('name', 'name'),
+          ('exchange', 'exchange'),
+          ('market-category', 'market_category'),
+          ('etf', 'etf'),
+          ('test-issue', 'test_issue'),
+          ('financial-status', 'financial_status'))
+
+# Financial status codes of the NASDAQ directory that mean "normal".
+# The others are D (deficient), E (delinquent), Q (bankrupt), and
+# combinations of these (G, H, J, K). Symbols listed on other
+# exchanges have no status.
+normal_statuses = ('N', '')
+
+class SymbolFilter(object):
+    """
+    Decides which symbols of the NASDAQ directory are worth screening,
+    based on the rows returned by collect.nasdaq.iter_nasdaq_rows().
+    exchanges is a list of listing exchange codes (e.g. "Q" for NASDAQ,
+    "N" for NYSE), or None for all.
+    """
+    def __init__(self, exclude_etf=False, exclude_test_issues=False,
+                 normal_status=False, exchanges=None):
+        self.exclude_etf = exclude_etf
+        self.exclude_test_issues = exclude_test_issues
+        self.normal_status = normal_status
+        self.exchanges = set(exchanges) if exchanges else None
+
+    def __bool__(self):
+        return bool(self.exclude_etf
+                    or self.exclude_test_issues
+                    or self.normal_status
+                    or self.exchanges)
+
+    def matches(self, row):
+        if self.exclude_etf and row['etf']:
+            return False
+        if self.exclude_test_issues and row['test-issue']:
+            return False
+        if self.normal_status and row['financial-status'] not in normal_statuses:
+            return False
+        if self.exchanges is not None and row['exchange'] not in self.exchanges:
+            return False
+        return True
+
+class SymbolIndex(object):
+    """
+    The full rows of the NASDAQ symbol directories, kept in a SQLite
+    file so that symbol lists from any source can be filtered by them
+    without downloading the directories again.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(schema)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def update(self, source, rows):
+        """
+        Replaces the rows of the given directory (e.g. "nasdaq-listed").
+        Returns the number of rows.
+        """
+        rows = [(source,) + tuple(row.get(key) for key, column in fields) for row in rows]
+        with stats.timer('disk', 'symbol-index'), self.lock, self.db:
+            self.db.execute('DELETE FROM symbols WHERE source=?', (source,))
+            self.db.executemany('INSERT OR REPLACE INTO symbols VALUES ({})'.format(
+                ', '.join('?' * (len(fields)+1))), rows)
+        return len(rows)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(DISTINCT symbol) FROM symbols').fetchone()[0]
+
+    def lookup(self, symbols=None, source=None):
+        """
+        Returns a dict mapping each of the given symbols (all by default)
+        that is in the index to its row. If a symbol is listed in more
+        than one directory, the row of the given source is used, or any.
+        """
+        columns = ', '.join(column for key, column in fields)
+        sql = 'SELECT {}, source=? FROM symbols'.format(columns)
+        if symbols is not None:
+            symbols = list(symbols)
+        if symbols is not None and len(symbols) <= 500:
+            sql += ' WHERE symbol IN ({})'.format(', '.join('?' * len(symbols)))
+            params = [source] + symbols
+        else:
+            params = [source]
+        wanted = None if symbols is None else set(symbols)
+        # Rows of the given source come last, so they replace the others.
+        result = {}
+        with stats.timer('disk', 'symbol-index'), self.lock:
+            for row in self.db.execute(sql + ' ORDER BY 8', params):
+                if wanted is not None and row[0] not in wanted:
+                    continue
+                row = dict((key, value) for (key, column), value in zip(fields, row))
+                row['etf'] = bool(row['etf'])
+                row['test-issue'] = bool(row['test-issue'])
+                result[row['symbol']] = row
+        return result
+
+    def filter(self, symbols, symbol_filter):
+        """
+        Returns the given symbols that pass the given SymbolFilter, in
+        their original order. Symbols that are not in the index (e.g.
+        those of other exchanges, like LHA.DE) are kept.
+        """
+        symbols = list(symbols)
+        rows = self.lookup(symbols)
+        result = [s for s in symbols if s not in rows or symbol_filter.matches(rows[s])]
+        stats.count('symbols', 'filtered', len(symbols) - len(result))
+        return result